@@ -2,6 +2,11 @@ import json
 
 import numpy as np
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library is used without it
+    orjson = None
+
 
 class UniversalEncoder(json.JSONEncoder):
     """
@@ -32,3 +37,54 @@ class UniversalEncoder(json.JSONEncoder):
         else:
             # Call the default method for other cases
             return super().default(o)
+
+
+# numpy arrays are serialized natively and dictionary keys are converted to strings like json.dumps does
+_ORJSON_OPTIONS = (
+    orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+)
+_universal_default = UniversalEncoder().default
+
+
+def dumps(obj):
+    """
+    Serializes an object into a JSON string, handling the same types as UniversalEncoder.
+    Uses orjson when it is installed, and json with UniversalEncoder otherwise.
+
+    Args:
+        obj (any): The object to serialize.
+
+    Returns:
+        str: The JSON string.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, default=_universal_default, option=_ORJSON_OPTIONS
+            ).decode()
+        except TypeError:
+            # e.g. integers larger than 64 bits, which json supports
+            pass
+
+    return json.dumps(obj, cls=UniversalEncoder)
+
+
+def dumpb(obj):
+    """
+    Serializes an object into UTF-8 encoded JSON, like `dumps`. With orjson the bytes it produces
+    are returned as they are, without building a string.
+
+    Args:
+        obj (any): The object to serialize.
+
+    Returns:
+        bytes: The JSON document.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_universal_default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # e.g. integers larger than 64 bits, which json supports
+            pass
+
+    return json.dumps(obj, cls=UniversalEncoder).encode()
@@ -1,15 +1,20 @@
+import itertools
 import json
 import os
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional
 
 import numpy as np
+from datafed import MessageLib
 from datafed.CommandLib import API
 from m3util.globus.globus import check_globus_endpoint
 from tqdm import tqdm
 
-from datafed_torchflow.JSON import UniversalEncoder
+from datafed_torchflow.JSON import dumps
+from datafed_torchflow.utils import prefetch
 
 
 class DataFed(API):
@@ -64,6 +69,11 @@ class DataFed(API):
         self.logging = logging
         self.log_file_path = log_file_path
 
+        # the thread retrieving the next records, created on first use and kept until close so that
+        # its DataFed connection is reused, see _prefetcher
+        self._prefetch_pool = None
+        self._prefetch_lock = threading.Lock()
+
         # checks if the user is autenticated with DataFed
         # and the Globus endpoint is set
         self.check_if_logged_in()
@@ -78,6 +88,102 @@ class DataFed(API):
         # Set the data path
         # self.data_path = data_path
 
+    @property
+    def _mapi(self):
+        """
+        The message API used to send requests to the DataFed server. Overrides the attribute
+        set by the DataFed API (CommandLib.API), which is shared by every thread.
+
+        A message API wraps a single ZeroMQ socket, which cannot be shared between threads
+        sending requests at the same time. The threads of the pools sending requests in the
+        background (see `thread_pool`) open their own connection once, with `connect_thread`.
+        Every other thread uses the connection opened by the DataFed API, as before.
+
+        Returns:
+            MessageLib.API: The message API of the calling thread.
+        """
+        if threading.get_ident() == self._mapi_owner:
+            return self._owner_mapi
+
+        return getattr(self._thread_mapi, "mapi", self._owner_mapi)
+
+    @_mapi.setter
+    def _mapi(self, mapi):
+        """
+        Sets the message API of the thread creating the DataFed connection.
+
+        Args:
+            mapi (MessageLib.API): The message API opened by the DataFed API.
+        """
+        self._mapi_owner = threading.get_ident()
+        self._owner_mapi = mapi
+        self._thread_mapi = threading.local()
+
+    def connect_thread(self):
+        """
+        Opens a DataFed connection for the calling thread, used for every request it sends
+        afterwards (see `_mapi`). Opening a connection checks the client version and the
+        authentication, so it is meant for long-lived threads such as the workers of `thread_pool`.
+
+        The new connection authenticates with the key files of the DataFed client only, so it
+        requires a login through the DataFed CLI. A login by password or token only authenticates
+        the connection of the thread that created this instance.
+
+        Raises:
+            RuntimeError: If the new connection could not be authenticated with the key files.
+        """
+        mapi = MessageLib.API(**self._setSaneDefaultOptions())
+        mapi.setNackExceptionEnabled(True)
+
+        if not mapi.getAuthStatus()[0]:
+            raise RuntimeError(
+                "The DataFed connection of a background thread could not be authenticated. "
+                "Background threads authenticate with the key files of the DataFed client, "
+                "log in with the DataFed CLI (datafed setup) instead of by password or token."
+            )
+
+        self._thread_mapi.mapi = mapi
+
+    def thread_pool(self, max_workers):
+        """
+        Creates threads sending requests to DataFed in the background, each with its own connection
+        opened when the thread starts, see `connect_thread`.
+
+        Args:
+            max_workers (int): The number of threads.
+
+        Returns:
+            ThreadPoolExecutor: The threads.
+        """
+        return ThreadPoolExecutor(
+            max_workers=max_workers, initializer=self.connect_thread
+        )
+
+    def _prefetcher(self):
+        """
+        Gets the thread retrieving the next records from DataFed, see `_get_metadata_list`.
+        It is created on first use and kept until `close`, so that its DataFed connection
+        is opened once instead of for every call.
+
+        Returns:
+            ThreadPoolExecutor: The thread retrieving the records.
+        """
+        with self._prefetch_lock:
+            if self._prefetch_pool is None:
+                self._prefetch_pool = self.thread_pool(1)
+            return self._prefetch_pool
+
+    def close(self):
+        """
+        Stops the thread retrieving the records, which closes its DataFed connection.
+        The instance can still be used afterwards, the thread is created again if needed.
+        """
+        with self._prefetch_lock:
+            pool, self._prefetch_pool = self._prefetch_pool, None
+
+        if pool is not None:
+            pool.shutdown(wait=True)
+
     def upload_dataset_to_DataFed(self):
         """
         Checks whether the dataset record already exists on DataFed and uploads it to a collection called ``dataset" (which it will create if necessary)
@@ -535,23 +641,28 @@ class DataFed(API):
         record_title: Optional[str] = None,
         parent_collection=None,
         deps=None,
+        check_session=True,
         **kwargs,
     ):
         """
         Creates the DataFed record for the saved checkpoint and uploads the relevant metadata
 
         Args:
-            metadata (dict): The relevant model and system metadata for the checkpoint.
+            metadata (dict or str): The relevant model and system metadata for the checkpoint.
+                Metadata already serialized into a JSON string is sent as is.
             record_title (str): The title of the DataFed record.
             deps (list or str, optional): A list of dependencies or a single dependency to add. Defaults to None.
+            check_session (bool, optional): Whether to check the Globus endpoint and the DataFed
+                authentication before creating the record. Defaults to True.
         Raises:
             Exception: If user is not authenticated or must re-authenticate
 
         """
-        # make sure the Globus endpoint is set
-        self.check_if_endpoint_set()
-        # make sure the user is logged into DataFed
-        self.check_if_logged_in()
+        if check_session:
+            # make sure the Globus endpoint is set
+            self.check_if_endpoint_set()
+            # make sure the user is logged into DataFed
+            self.check_if_logged_in()
 
         if record_title is None:
             raise ValueError("record_title cannot be None")
@@ -575,7 +686,7 @@ class DataFed(API):
         try:
             dc_resp = self.dataCreate(
                 str(record_title).rsplit("/", 1)[-1],
-                metadata=json.dumps(metadata, cls=UniversalEncoder),
+                metadata=metadata if isinstance(metadata, str) else dumps(metadata),
                 parent_id=parent_collection
                 if parent_collection is not None
                 else self.collection_id,
@@ -601,6 +712,42 @@ class DataFed(API):
 
             raise e
 
+    def data_record_create_batch(self, records, chain=False):
+        """
+        Creates several DataFed records, checking the Globus endpoint and the DataFed
+        authentication once for the whole batch rather than once per record.
+
+        Args:
+            records (list): A list of dictionaries, each holding the keyword arguments
+                passed to `data_record_create` for one record.
+            chain (bool, optional): If True, each record is marked as derived from the
+                record created before it in the batch. Defaults to False.
+
+        Returns:
+            list: The DataFed replies for the created records, in the order of `records`.
+
+        Raises:
+            Exception: If user is not authenticated or must re-authenticate
+        """
+        # make sure the Globus endpoint is set
+        self.check_if_endpoint_set()
+        # make sure the user is logged into DataFed
+        self.check_if_logged_in()
+
+        responses = []
+        for record in records:
+            record = dict(record)
+
+            # link the record to the previous record of the batch
+            if chain and responses:
+                record["deps"] = list(record.get("deps") or []) + self.addDerivedFrom(
+                    responses[-1][0].data[0].id
+                )
+
+            responses.append(self.data_record_create(check_session=False, **record))
+
+        return responses
+
     def data_record_update(
         self,
         record_id=None,
@@ -651,7 +798,7 @@ class DataFed(API):
             dc_resp = self.dataUpdate(
                 record_id,
                 title=str(record_title).rsplit("/", 1)[-1],
-                metadata=json.dumps(metadata, cls=UniversalEncoder),
+                metadata=dumps(metadata),
                 deps_add=deps,
                 metadata_set=overwrite_metadata,
                 # **kwargs,
@@ -749,20 +896,97 @@ class DataFed(API):
         """
         return [record.id for record in listing_reply.item]
 
-    def getIDsInCollection(self, collection_id=None):
+    def iter_collection_pages(
+        self, collection_id=None, page_size=500, offset=0, prefetch_depth=2
+    ):
+        """
+        Yields the items of a collection one page at a time. The next pages are listed by the
+        prefetch thread (see `_prefetcher`) while the current one is consumed, so listing overlaps
+        with the processing of the items and at most `prefetch_depth` + 1 pages are held in memory.
+
+        Args:
+            collection_id (str, optional): The ID of the collection to list. Defaults to the current collection.
+            page_size (int, optional): The number of items listed by each request to DataFed. Defaults to 500.
+            offset (int, optional): The number of items to skip. Defaults to 0.
+            prefetch_depth (int, optional): The number of pages listed ahead of the consumer. Up to this many
+                requests past the last page may be sent. Defaults to 2, 0 lists each page when it is reached.
+
+        Yields:
+            list: The items of each non-empty page, as returned by collectionItemsList.
+        """
+        if collection_id is None:
+            collection_id = self.collection_id
+
+        def list_page(page_offset):
+            return list(
+                self.collectionItemsList(
+                    collection_id, offset=page_offset, count=page_size
+                )[0].item
+            )
+
+        pages = prefetch(
+            itertools.count(offset, page_size),
+            list_page,
+            depth=prefetch_depth,
+            executor=self._prefetcher(),
+        )
+        try:
+            for _, items in pages:
+                if items:
+                    yield items
+
+                # a short page is the last one, the pages listed after it are cancelled
+                if len(items) < page_size:
+                    return
+        finally:
+            pages.close()
+
+    def iter_collection_items(
+        self, collection_id=None, page_size=500, offset=0, prefetch_depth=2
+    ):
+        """
+        Yields the items of a collection one at a time, listing the collection one page at a time,
+        see `iter_collection_pages`.
+
+        Args:
+            collection_id (str, optional): The ID of the collection to list. Defaults to the current collection.
+            page_size (int, optional): The number of items listed by each request to DataFed. Defaults to 500.
+            offset (int, optional): The number of items to skip. Defaults to 0.
+            prefetch_depth (int, optional): The number of pages listed ahead of the consumer. Defaults to 2.
+
+        Yields:
+            The items of the collection, as returned by collectionItemsList.
+        """
+        for items in self.iter_collection_pages(
+            collection_id, page_size, offset, prefetch_depth
+        ):
+            yield from items
+
+    def getIDsInCollection(self, collection_id=None, offset=0, count=None):
         """
         Gets the IDs of items in a collection.
         Args:
             collection_id (str): The ID of the collection to query.
+            offset (int, optional): The number of items to skip. Defaults to 0.
+            count (int, optional): The maximum number of items to return. Defaults to None, returning every item.
         Returns:
             list: A list of item IDs in the collection.
         """
         if collection_id is None:
             collection_id = self.collection_id
 
-        # TODO: make it so it can return more than 10000 records -- not hardcoded
+        # every ID is returned, so list large pages without listing ahead: one request unless the
+        # collection exceeds a page. Use iter_collection_items to process the items while the collection is listed
+        if count is None:
+            items = self.iter_collection_items(
+                collection_id, page_size=10000, offset=offset, prefetch_depth=0
+            )
+            return [record.id for record in items]
+
         # Get the list of items in the collection
-        collection_list = self.collectionItemsList(collection_id, count=10000)[0]
+        collection_list = self.collectionItemsList(
+            collection_id, offset=offset, count=count
+        )[0]
 
         # Return the IDs of the items in the collection
         return self.getIDs(collection_list)
@@ -774,6 +998,7 @@ class DataFed(API):
         excluded_keys=None,
         non_unique=None,
         format="pandas",
+        record_ids=None,
     ):
         """
         Retrieves the metadata record for a specified record ID.
@@ -783,7 +1008,10 @@ class DataFed(API):
             exclude_metadata (str, list, or None, optional): Metadata fields to exclude from the extraction record.
             excluded_keys (str, list, or None, optional): Keys if the metadata record contains to exclude.
             non_unique (str, list, or None, optional): Keys which are expected to be unique independent of record uniqueness - these are not considered when finding unique records.
-            format (str, optional): The format to return the metadata in. Defaults to "pandas".
+            format (str, optional): The format to return the metadata in, "pandas" for a pandas.DataFrame or
+                "arrow" for a pyarrow.Table (requires pyarrow). Defaults to "pandas".
+            record_ids (list, optional): The IDs of the records to retrieve, e.g. one page of the collection.
+                Defaults to the records of the collection.
 
         Returns:
             dict: The metadata record.
@@ -793,40 +1021,108 @@ class DataFed(API):
         if collection_id is None:
             collection_id = self.collection_id
 
-        # Retrieve the data view response for the given record ID
-        # TODO: make it so it can return more than 10000 records -- not hardcoded
-        _collection_list = self.collectionItemsList(self.collection_id, count=10000)[0]
+        if format not in ("pandas", "arrow"):
+            return ValueError(
+                "Invalid format in get_metadata. Please use 'pandas' or 'arrow'."
+            )
 
-        # Get the record IDs from the collection list
-        record_ids_ = self.getIDsInCollection(collection_id=self.collection_id)
+        # Get the record IDs from the collection list, the metadata of the first records is
+        # retrieved while the next pages are listed
+        if record_ids is None:
+            record_ids = (
+                record.id for record in self.iter_collection_items(collection_id)
+            )
 
         # Gets a list of Metadata excluding specific metadata terms
-        metadata_ = self._get_metadata_list(record_ids_, exclude=exclude_metadata)
+        metadata_ = self._get_metadata_list(record_ids, exclude=exclude_metadata)
 
-        # Exclude specific records if specified key is in the record
+        if format == "arrow":
+            return self._metadata_table(metadata_, excluded_keys, non_unique)
+
+        import pandas as pd
+
+        # Exclude specific records if specified key is in the record. This depends on the keys of the records,
+        # which the dataframe does not keep (a missing key and a None value are both NaN), and removes the
+        # excluded keys from the columns
         metadata_ = self.exclude_keys(metadata_, excluded_keys)
 
+        df = pd.DataFrame(metadata_)
+        df = df.loc[:, ~df.columns.duplicated()]
+
+        # Keep the first of the records that only differ by the non unique keys
         if non_unique is not None:
-            metadata_ = self.get_unique_dicts(metadata_, exclude_keys=non_unique)
+            if isinstance(non_unique, str):
+                non_unique = [non_unique]
+
+            # compare one 64-bit signature per record instead of every value; dictionaries and lists
+            # cannot be hashed by pandas, so every value is hashed through its string representation
+            compared = df.columns.difference(list(non_unique), sort=False)
+            if len(compared) > 0:
+                signature = pd.util.hash_pandas_object(
+                    df[compared].astype(str), index=False
+                )
+                df = df[~signature.duplicated().to_numpy()]
 
-        if format == "pandas":
-            import pandas as pd
+        df = df.reset_index(drop=True)
+        self.pd_df = df
 
-            self.pd_df = pd.DataFrame(metadata_)
+        return df.copy()
 
-            return pd.DataFrame(metadata_)
-        else:
-            return ValueError("Invalid format in get_metadata. Please use 'pandas'.")
+    def _metadata_table(self, metadata, excluded_keys=None, non_unique=None):
+        """
+        Builds a columnar pyarrow.Table from a list of metadata records.
+
+        The nested metadata becomes struct and list columns, which Arrow cannot compare row by row,
+        so the records are filtered and made unique as dictionaries before the table is built.
+        Each top-level key is a column. A column whose values do not share one Arrow type
+        (e.g. a field that is a number in some records and a string in others) holds the
+        values serialized into JSON strings instead.
+
+        Args:
+            metadata (list): The metadata records.
+            excluded_keys (str, list, or None, optional): Keys if the metadata record contains to exclude.
+            non_unique (str, list, or None, optional): Keys not considered when finding unique records.
+
+        Returns:
+            pyarrow.Table: The metadata records, one row per record.
+        """
+        import pyarrow as pa
+
+        metadata = self.exclude_keys(metadata, excluded_keys)
+
+        if non_unique is not None:
+            if isinstance(non_unique, str):
+                non_unique = [non_unique]
+            metadata = self.get_unique_dicts(metadata, exclude_keys=non_unique)
+
+        # the keys of every record, in the order they are first seen
+        keys = dict.fromkeys(key for record in metadata for key in record)
+
+        columns = {}
+        for key in keys:
+            values = [record.get(key) for record in metadata]
+            try:
+                columns[key] = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                columns[key] = pa.array(
+                    [None if value is None else dumps(value) for value in values],
+                    type=pa.string(),
+                )
+
+        return pa.table(columns)
 
     def _get_metadata_list(self, record_ids, exclude=None):
         metadata = []
-        for record_id in tqdm(record_ids):
-            metadata_ = self._get_metadata(record_id)
 
+        # the next records are retrieved from DataFed while the current one is processed
+        for _, metadata_ in tqdm(
+            prefetch(record_ids, self._get_metadata, executor=self._prefetcher()),
+            total=len(record_ids) if hasattr(record_ids, "__len__") else None,
+        ):
             if exclude is not None:
                 if exclude == "computing":
                     metadata_ = self._remove_computing_metadata(metadata_)
-                elif isinstance(exclude, list):
+                elif isinstance(exclude, (list, tuple)):
                     metadata_ = self._exclude_metadata_fields(metadata_, exclude)
                 else:
                     with open(self.log_file_path, "a") as f:
@@ -904,7 +1200,7 @@ class DataFed(API):
         # Ensure excluded_keys is a list, even if a single string is provided
         if isinstance(excluded_keys, str):
             excluded_keys = [excluded_keys]
-        elif not isinstance(excluded_keys, (list, set)):
+        elif not isinstance(excluded_keys, (list, set, tuple)):
             with open(self.log_file_path, "a") as f:
                 timestamp = datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -1242,3 +1538,35 @@ class DataFed(API):
                 return True
             else:
                 return False
+
+
+# DataFed clients shared by the viewers, see get_client
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(datafed_path, **kwargs):
+    """
+    Returns a DataFed client for a DataFed path, creating it on the first call. Later calls with the
+    same arguments reuse the client, and so its authenticated connection to the DataFed server,
+    instead of logging in and looking up the collection again. Each thread using the client opens
+    one connection of its own, see `DataFed._mapi`.
+
+    The client is shared, so it should only be used for reading. TorchLogger creates its own client.
+
+    Args:
+        datafed_path (str): The DataFed collection, as either a collection ID or a directory path.
+        **kwargs: The other arguments of `DataFed`.
+
+    Returns:
+        DataFed: The shared DataFed client.
+    """
+    key = (datafed_path, json.dumps(kwargs, sort_keys=True, default=str))
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = DataFed(datafed_path, **kwargs)
+            _clients[key] = client
+
+    return client
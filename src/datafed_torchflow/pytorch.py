@@ -1,40 +1,189 @@
-import os
-import sys
-from datetime import datetime
-from typing import Any, Optional
-
-import torch
-import torch.nn as nn
-from torch.utils.data import DataLoader
-
-sys.path.append(os.path.abspath("/home/jg3837/DataFed_TorchFlow/DataFed_TorchFlow/src"))
-
-
+"""
+Logging of PyTorch training runs to DataFed.
+
+The checkpoint path (``TorchLogger.save`` -> ``TorchLogger.getMetadata`` ->
+``DataFed.data_record_create`` -> ``DataFed.upload_file``) is bound by I/O and the
+Python interpreter, not by arithmetic: nearly all of its wall time is spent in the
+per-variable reflection of ``getMetadata`` and in the synchronous DataFed round-trips
+issued for every checkpoint. There is no numeric loop in this module, so
+optimizations should target batching and deferring the DataFed calls, caching
+metadata that does not change between checkpoints, and removing redundant work,
+rather than vectorizing or moving work to the GPU.
+"""
+
+import atexit
+import collections
+import functools
 import getpass
+import hashlib
 import json
 import logging
+import os
 import pathlib
-import traceback
+import queue
+import tempfile
+import threading
+import time
 import types
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+from typing import Any, ClassVar, Optional
 
 import numpy as np
+import torch
+import torch.nn as nn
 from datafed.CommandLib import API
 from m3util.globus.globus import check_globus_file_access
 from m3util.util.IO import find_files_recursive, make_folder
+from torch.utils.data import DataLoader, Dataset, Sampler
 from tqdm import tqdm
 
 from datafed_torchflow.computer import get_system_info
-from datafed_torchflow.datafed import DataFed
+from datafed_torchflow.datafed import DataFed, get_client
+from datafed_torchflow.JSON import dumpb, dumps
 from datafed_torchflow.utils import (
+    contains_tensor,
     extract_instance_attributes,
-    getNotebookMetadata,
+    getNotebookMetadataCached,
+    is_jsonable,
+    prefetch,
     serialize_model,
     serialize_pytorch_optimizer,
+    state_dict_to_cpu,
+    tensors_to_lists,
 )
 
 # TODO: Add data and dataloader derivative.
 # TODO: Add number of FLOPS to metadata
 
+# local variables never added to the metadata, compared case-insensitively
+_EXCLUDE_KEYS = frozenset(
+    {
+        "checkpoint",
+        "self",
+        "local_vars",
+        "model_dict",
+        "model_hyperparameters",
+        "i",
+        "image",
+        "key",
+        "value",
+    }
+)
+
+# types of the local variables never added to the metadata
+_EXCLUDE_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    API,
+    DataLoader,
+    Dataset,
+    Sampler,
+    type(None),
+    types.MethodType,
+)
+
+# names accepted for the optimizer, compared case-insensitively
+_OPTIM_KEYS = frozenset({"optimizer", "optim", "optim_", "optimizer_"})
+
+
+def _short_enough(values, limit=1000):
+    """
+    Checks whether the representations of the items of a list add up to fewer than `limit` characters,
+    stopping as soon as the limit is reached.
+
+    Args:
+        values (list): The list to check.
+        limit (int, optional): The maximum number of characters. Defaults to 1000.
+
+    Returns:
+        bool: True if the list is short enough to be added to the metadata.
+    """
+    total = 0
+    for value in values:
+        total += len(repr(value))
+        if total >= limit:
+            return False
+    return True
+
+
+# markers put on the write-back queue of the TorchLogger to flush or stop the writer thread
+_FLUSH = object()
+_STOP = object()
+
+# marks the DataFed ID of the dataset as not looked up yet
+_UNSET = object()
+
+# attributes of these types are compared by value in the signature of a model architecture block
+_SCALAR_TYPES = (bool, int, float, str, type(None))
+
+
+class _PinnedPool:
+    """
+    A pool of CPU tensors holding the copies of the state dictionaries, reused across checkpoints
+    so that (pinned) host memory is not allocated again for every checkpoint. The tensors are
+    pinned when CUDA is available.
+
+    Attributes:
+        max_bytes (int): Soft cap on the memory kept in the pool. Tensors released while the pool
+            holds more than this are dropped.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        """
+        Initializes the pool.
+
+        Args:
+            max_bytes (int, optional): Soft cap on the memory kept in the pool. Default is 1 GiB.
+        """
+        self.max_bytes = max_bytes
+        self._pin_memory = torch.cuda.is_available()
+        self._free = collections.defaultdict(collections.deque)
+        self._bytes = 0
+
+        # tensors are acquired by the training thread and released by the background writer
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        """
+        Takes a tensor of the given shape and dtype from the pool, or allocates one.
+
+        Args:
+            shape (torch.Size or tuple): The shape of the tensor.
+            dtype (torch.dtype): The dtype of the tensor.
+
+        Returns:
+            torch.Tensor: An uninitialized CPU tensor.
+        """
+        key = (tuple(shape), dtype)
+
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                tensor = free.pop()
+                self._bytes -= tensor.numel() * tensor.element_size()
+                return tensor
+
+        return torch.empty(key[0], dtype=dtype, pin_memory=self._pin_memory)
+
+    def release(self, tensor):
+        """
+        Returns a tensor taken with `acquire` to the pool once it is no longer used.
+
+        Args:
+            tensor (torch.Tensor): The tensor to return.
+        """
+        nbytes = tensor.numel() * tensor.element_size()
+
+        with self._lock:
+            if self._bytes + nbytes > self.max_bytes:
+                return
+
+            self._free[(tuple(tensor.shape), tensor.dtype)].append(tensor)
+            self._bytes += nbytes
+
 
 class TorchLogger:
     """
@@ -51,6 +200,10 @@ class TorchLogger:
         local_model_path (str): Local directory to store model files.
         input_data_shape (tuple): Shape of the input training data for the model.
         logging (bool): Whether to display logging output.
+        consistency (str): "wt" to write each checkpoint through to DataFed when it is saved,
+            or "wb" to buffer checkpoints and write them back from a background thread.
+        batch_size (int): Number of buffered checkpoints that triggers a write-back.
+        flush_interval (float): Maximum number of seconds a checkpoint stays buffered.
 
     """
 
@@ -65,6 +218,9 @@ class TorchLogger:
         dataset_id_or_path=None,
         logging=False,
         download_kwargs={"wait": True, "orig_fname": True},
+        consistency="wt",
+        batch_size=8,
+        flush_interval=60.0,
     ):
         """
         Initializes the TorchLogger class.
@@ -81,8 +237,21 @@ class TorchLogger:
             dataset_id (str, default=None): DataFed ID for the input dataset for the model
             logging (bool, optional): Flag for logging output. Default is False.
             optimizer (torch.optim.Optimizer, optional): The optimizer used for training. Default is None.
+            consistency (str, optional): "wt" (write-through) uploads every checkpoint to DataFed
+                before `save` returns. "wb" (write-back) queues the checkpoints and uploads them
+                from a background thread, so training does not wait on DataFed. Default is "wt".
+            batch_size (int, optional): With "wb", the number of queued checkpoints committed
+                to DataFed together. Default is 8.
+            flush_interval (float, optional): With "wb", the maximum number of seconds a
+                checkpoint is kept in the queue before it is committed. Default is 60.
+
+        Raises:
+            ValueError: If `consistency` is neither "wt" nor "wb".
         """
 
+        if consistency not in ("wt", "wb"):
+            raise ValueError(f'consistency must be "wt" or "wb", got "{consistency}"')
+
         self.current_checkpoint_id = None
         self.notebook_record_id = None
         self.__file__ = script_path
@@ -97,9 +266,29 @@ class TorchLogger:
         self.download_kwargs = download_kwargs
 
         self.logging = logging
+        self._log = self._file_logger()
         self.input_data_shape = input_data_shape
 
-        make_folder(self.local_model_path)
+        # number of elements in the input data, arrays smaller than this are added to the metadata
+        self._input_numel = (
+            int(np.prod(input_data_shape)) if input_data_shape is not None else None
+        )
+
+        # side stream copying the state dictionaries from the GPU, and the host memory they are
+        # copied into, see _snapshot_state_dicts
+        self._copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self._pool = _PinnedPool()
+
+        # serialized model architecture blocks, see _architecture_metadata
+        self._arch_cache = {}
+
+        self.consistency = consistency
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # create the folder for the checkpoints unless it already exists
+        if not os.path.isdir(self.local_model_path):
+            make_folder(self.local_model_path)
 
         self.df_api = DataFed(
             self.DataFed_path,
@@ -115,11 +304,198 @@ class TorchLogger:
             self.df_api.endpointDefaultGet(), self.local_model_path
         )
 
+        # threads uploading the files to DataFed; each one opens its own DataFed connection
+        self._upload_pool = self.df_api.thread_pool(4)
+        self._notebook_upload = None
+
+        # DataFed ID of the dataset, looked up once for the dataset_id_or_path it was found for
+        self.dataset_id = None
+        self._dataset_source = _UNSET
+
         # Save the notebook to DataFed
         self.save_notebook()
 
+        # start the background writer that commits the queued checkpoints to DataFed
+        self._write_q = queue.Queue()
+        self._writer = None
+        self._writer_error = None
+        if self.consistency == "wb":
+            self._writer = threading.Thread(target=self._flush_loop, daemon=True)
+            self._writer.start()
+
+            # commit the checkpoints still queued when the interpreter exits, unregistered by close
+            atexit.register(self.close)
+
+    def _file_logger(self):
+        """
+        Gets the logger writing to the log file. The file is opened on the first message
+        and kept open, instead of being reopened for every message. Loggers are never freed,
+        so there is one logger per log file, shared by the TorchLoggers writing to it.
+
+        Returns:
+            logging.Logger: The logger of the log file.
+        """
+        log = logging.getLogger(
+            f"{__name__}.TorchLogger.{os.path.abspath(self.log_file_path)}"
+        )
+        if log.handlers:
+            return log
+
+        log.setLevel(logging.INFO)
+        log.propagate = False
+
+        handler = logging.FileHandler(self.log_file_path, delay=True)
+        handler.setFormatter(
+            logging.Formatter("\n %(asctime)s - %(message)s", "%Y-%m-%d %H:%M:%S")
+        )
+        handler.terminator = ""
+        log.addHandler(handler)
+        return log
+
     def reset(self):
+        # commit the queued checkpoints before starting a new chain of checkpoints
+        self.flush()
         self.current_checkpoint_id = None
+        self._arch_cache.clear()
+
+    def reset_dataset(self):
+        """
+        Forgets the DataFed ID of the dataset, so that the next checkpoint checks the dataset
+        on DataFed again and uploads it if necessary.
+        """
+        self.dataset_id = None
+        self._dataset_source = _UNSET
+
+    def _get_dataset_id(self):
+        """
+        Returns the DataFed ID of the dataset, uploading the dataset to DataFed the first time
+        and whenever `dataset_id_or_path` changes.
+
+        Returns:
+            str or list: The DataFed ID(s) of the dataset files, or None if no dataset is specified.
+        """
+        source = self.dataset_id_or_path
+        key = tuple(source) if isinstance(source, list) else source
+        if key != self._dataset_source:
+            self.df_api.dataset_id_or_path = source
+            self.dataset_id = self.df_api.upload_dataset_to_DataFed()
+            self._dataset_source = key
+        return self.dataset_id
+
+    def flush(self):
+        """
+        Blocks until every checkpoint queued by `save` has been committed to DataFed.
+
+        Raises:
+            Exception: The error raised by the background writer while committing
+                the queued checkpoints, if any.
+        """
+        if self._writer is None or not self._writer.is_alive():
+            return
+
+        self._write_q.put(_FLUSH)
+        self._write_q.join()
+
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
+
+    def close(self):
+        """
+        Commits the queued checkpoints to DataFed, stops the background writer
+        and waits for the uploads still in progress.
+        """
+        try:
+            if self._writer is not None and self._writer.is_alive():
+                try:
+                    self.flush()
+                finally:
+                    self._write_q.put(_STOP)
+                    self._writer.join()
+
+            self._wait_notebook_upload()
+        finally:
+            # the exit hook holds a reference to the logger
+            atexit.unregister(self.close)
+
+            self._upload_pool.shutdown(wait=True)
+            self.df_api.close()
+
+            # closes the log file, which is reopened if another TorchLogger writes to it
+            for handler in self._log.handlers:
+                handler.close()
+
+    def _wait_notebook_upload(self):
+        """
+        Waits for the upload of the notebook started by `save_notebook`, if any.
+
+        Raises:
+            Exception: The error raised while uploading the notebook.
+        """
+        if self._notebook_upload is not None:
+            upload, self._notebook_upload = self._notebook_upload, None
+            upload.result()
+
+    def _flush_loop(self):
+        """
+        Drains the write-back queue on the background writer thread. Each checkpoint
+        is saved locally as soon as it is dequeued, which returns its snapshot to the
+        pool. The saved checkpoints are committed to DataFed every `batch_size`
+        checkpoints, when the oldest one has been queued for `flush_interval` seconds,
+        or on request.
+        """
+        # the checkpoints to commit, and the number of other dequeued items (markers and
+        # checkpoints that could not be saved) to mark as done with them
+        batch, markers, deadline = [], 0, None
+
+        # the writer opens its own DataFed connection before its first commit
+        connected = False
+
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._write_q.get(timeout=timeout)
+                dequeued = True
+            except queue.Empty:
+                # the oldest queued checkpoint has waited for flush_interval seconds
+                item, dequeued = _FLUSH, False
+
+            if item is _FLUSH or item is _STOP:
+                markers += dequeued
+            else:
+                checkpoint_record, pending_save = item
+                try:
+                    if pending_save is not None:
+                        self._save_checkpoint(*pending_save)
+                except Exception as e:
+                    # a checkpoint that was not saved is not committed, raise it on the next flush
+                    self._writer_error = e
+                    markers += 1
+                else:
+                    batch.append(checkpoint_record)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+            if not (item is _FLUSH or item is _STOP or len(batch) >= self.batch_size):
+                continue
+
+            if batch:
+                try:
+                    if not connected:
+                        self.df_api.connect_thread()
+                        connected = True
+
+                    self._commit(batch)
+                except Exception as e:
+                    # DataFed already logged the error, raise it on the next flush
+                    self._writer_error = e
+
+            for _ in range(len(batch) + markers):
+                self._write_q.task_done()
+            batch, markers, deadline = [], 0, None
+
+            if item is _STOP:
+                return
 
     @property
     def optimizer(self):
@@ -160,7 +536,7 @@ class TorchLogger:
         """
 
         # get the model architecture names
-        model_architecture_names = list(self.model_dict.keys())
+        model_architecture_names = frozenset(self.model_dict.keys())
 
         # get the user information and timestamp
         current_user, current_time = self.getUserClock()
@@ -182,180 +558,54 @@ class TorchLogger:
         if model_hyperparameters is None:
             raise ValueError("model_hyperparameters cannot be None")
 
+        model_parameters = DataFed_record_metadata["Model Parameters"]
+        model_architecture = model_parameters["Model Architecture"]
+
         # loop through the local variables to add to the metadata dictionary
+        should_include = self._should_include
         for key, value in local_vars:
-            # exclude modules and other undesired local variables. Use casefold string matching for flexibility
-            if (
-                not key.startswith("_")
-                and key.casefold()
-                not in [
-                    "checkpoint",
-                    "self",
-                    "local_vars",
-                    "model_dict",
-                    "model_hyperparameters",
-                    "i",
-                    "image",
-                    "key",
-                    "value",
-                ]
-                and "datafed" not in key.casefold()
-                and "globus" not in key.casefold()
-                and "data".casefold() not in str(type(value)).casefold()
-                and "dataloader".casefold() not in str(type(value)).casefold()
-                and (
-                    not (callable(value) and key not in model_architecture_names)
-                    or not (
-                        callable(value)
-                        and key not in ["optimizer", "optim", "optim_", "optimizer_"]
-                    )
-                )
-                and type(value)
-                not in [
-                    type,
-                    types.ModuleType,
-                    types.FunctionType,
-                    API,
-                    DataLoader,
-                    types.NoneType,
-                    types.MethodType,
-                ]
-            ):
-                # put the model architecture into the Model Architecture sub-dictionary
-                if key in model_architecture_names:
-                    # serialize the optimizer
-                    if not isinstance(value, str) and key.casefold() in [
-                        "optimizer",
-                        "optim",
-                        "optim_",
-                        "optimizer_",
-                    ]:  # accept "optimizer" or "optim" for flexibility
-                        DataFed_record_metadata["Model Parameters"][
-                            "Model Architecture"
-                        ][key] = serialize_pytorch_optimizer(value)
+            key_casefold = key.casefold()
 
-                    else:
-                        # serialize the model architecture blocks (encoder, decoder, etc. )
-                        DataFed_record_metadata["Model Parameters"][
-                            "Model Architecture"
-                        ][key] = serialize_model(value)
-                        DataFed_record_metadata["Model Parameters"][
-                            "Model Architecture"
-                        ][key].update(extract_instance_attributes(obj=value))
-
-                # serialize the optimizer if not in model_dict
-                elif not isinstance(value, str) and key.casefold() in [
-                    "optimizer",
-                    "optim",
-                    "optim_",
-                    "optimizer_",
-                ]:  # accept "optimizer" or "optim" for flexibility
-                    DataFed_record_metadata["Model Parameters"]["Model Architecture"][
-                        key
-                    ] = serialize_pytorch_optimizer(value)
-
-                # extract lists if they are not too long (arbitrarily chose to be less than 1000 characters)
-                elif isinstance(value, list):
-                    # ignore long lists
-                    if sum(len(str(s)) for s in value) < 1000:
-                        # extract the value for 1 item lists
-                        if len(value) == 1:
-                            DataFed_record_metadata["Model Parameters"][key] = value[0]
-                        else:
-                            # if the list has many (but not too many values) extract the whole list
-                            DataFed_record_metadata["Model Parameters"][key] = value
-                    else:
-                        warning_message = (
-                            f'List in key "{key}" is too long to be extracted'
-                        )
-                        Warning(warning_message)
-                # put the model hyperparameters in the Model Hyperparameters sub-dictionary (the hyperparameters might be 1-value torch tensors or just floats)
-                elif key in model_hyperparameters.keys():
-                    if (
-                        isinstance(value, (np.ndarray, torch.Tensor))
-                        and self.input_data_shape is not None
-                    ):
-                        if value.shape < self.input_data_shape:
-                            DataFed_record_metadata["Model Parameters"][
-                                "Model Hyperparameters"
-                            ][key] = value.tolist()
-                    else:
-                        DataFed_record_metadata["Model Parameters"][
-                            "Model Hyperparameters"
-                        ][key] = value
-
-                # convert numpy arrays and torch tensors that are small enough (arbitrarily chosen to be smaller than the input data dimensions)
-                # into lists so they can be serialized into JSON
-                elif isinstance(value, (np.ndarray, torch.Tensor)):
-                    if (
-                        self.input_data_shape is not None
-                        and value.shape < self.input_data_shape
-                    ):
-                        # put other lists into the Model Parameters dictionary
-                        try:
-                            json.dumps(value.tolist())
-                            DataFed_record_metadata["Model Parameters"][key] = (
-                                value.tolist()
-                            )
-                        except:
-                            DataFed_record_metadata["Model Parameters"][key] = str(
-                                value.tolist()
-                            )
-                # convert PosixPaths and pytorch devices into strings so they can be serialized into JSON
-                elif type(value) in [pathlib.PosixPath, torch.device]:
-                    DataFed_record_metadata["Model Parameters"][key] = str(value)
-                # convert class instances into dictionaries of their attributes so they can be serialized into JSON
-                elif hasattr(value, "__dict__"):
-                    if len(extract_instance_attributes(obj=value)) > 0:
-                        DataFed_record_metadata["Model Parameters"][key] = (
-                            extract_instance_attributes(obj=value)
-                        )
+            # exclude modules and other undesired local variables
+            if not should_include(key, key_casefold, value, model_architecture_names):
+                continue
+
+            value_type = type(value)
 
-                elif isinstance(value, dict) and len(value) > 0:
-                    if "_" not in str(type(value[list(value.keys())[0]])):
-                        try:
-                            json.dumps(value)
-                            DataFed_record_metadata["Model Parameters"][key] = value
-                        except (TypeError, ValueError, json.JSONDecodeError):
-                            DataFed_record_metadata["Model Parameters"][key] = str(
-                                value
-                            )
-
-                # all other cases, everything should be serializable (string, float, etc.)
+            # put the model architecture into the Model Architecture sub-dictionary
+            if key in model_architecture_names:
+                # serialize the optimizer
+                if not isinstance(value, str) and key_casefold in _OPTIM_KEYS:
+                    model_architecture[key] = serialize_pytorch_optimizer(value)
+
+                else:
+                    # serialize the model architecture blocks (encoder, decoder, etc. )
+                    model_architecture[key] = self._architecture_metadata(value)
+
+            # serialize the optimizer if not in model_dict
+            elif not isinstance(value, str) and key_casefold in _OPTIM_KEYS:
+                model_architecture[key] = serialize_pytorch_optimizer(value)
+
+            # put the model hyperparameters in the Model Hyperparameters sub-dictionary (the hyperparameters might be 1-value torch tensors or just floats)
+            elif key in model_hyperparameters and not isinstance(value, list):
+                if (
+                    isinstance(value, (np.ndarray, torch.Tensor))
+                    and self._input_numel is not None
+                ):
+                    if self._smaller_than_input(value):
+                        model_parameters["Model Hyperparameters"][key] = value.tolist()
                 else:
-                    # everything should be JSON serializable at this point, but try to convert to string and then skip if not
+                    model_parameters["Model Hyperparameters"][key] = tensors_to_lists(
+                        value
+                    )
 
-                    try:
-                        json.dumps(value)
-                        DataFed_record_metadata["Model Parameters"][key] = value
-                    except (TypeError, ValueError, json.JSONDecodeError):
-                        try:
-                            DataFed_record_metadata["Model Parameters"][key] = str(
-                                value
-                            )
-
-                        except (TypeError, ValueError, json.JSONDecodeError):
-                            if self.logging:
-                                tb = traceback.format_exc()
-                                with open(self.log_file_path, "a") as f:
-                                    timestamp = (
-                                        datetime.now()
-                                        .astimezone()
-                                        .strftime("%Y-%m-%d %H:%M:%S")
-                                    )
-
-                                    f.write(
-                                        f"\n {timestamp} - Could not convert {key} to JSON. {key} has type {type(key)}"
-                                    )
-                                    f.write(
-                                        f"the corresponding value has type {type(value)} and value \n {value}"
-                                    )
-                                    f.write(f"Python error message {tb}")
-                                    f.write("skipping this variable.")
+            # all other variables are added by the handler registered for their type
+            else:
+                self._metadata_handler(value_type)(self, key, value, model_parameters)
 
         # add the notebook checksum and file path to the Model Parameters dictionary
         DataFed_record_metadata["Model Parameters"].update(
-            getNotebookMetadata(self.__file__)
+            getNotebookMetadataCached(self.__file__)
         )
         # add the user and timestamp to the Model Parameters dictionary
         DataFed_record_metadata["Model Parameters"].update(
@@ -364,9 +614,212 @@ class TorchLogger:
         # add the computer information to the System Information section
         DataFed_record_metadata["System Information"] = computer_info
 
+        # tensors must be converted to lists before the metadata is serialized into JSON
+        assert not contains_tensor(DataFed_record_metadata), (
+            "The metadata contains a torch.Tensor"
+        )
+
         # return the metadata
         return DataFed_record_metadata
 
+    @staticmethod
+    def _should_include(
+        key: str, key_casefold: str, value: Any, model_names: frozenset[str]
+    ) -> bool:
+        """
+        Decides whether a local variable is added to the metadata. Uses casefold string matching for flexibility.
+
+        Args:
+            key (str): The name of the local variable.
+            key_casefold (str): The casefolded name of the local variable.
+            value (Any): The value of the local variable.
+            model_names (frozenset): The names of the model architecture blocks in model_dict.
+
+        Returns:
+            bool: False for private names, modules, DataFed and Globus objects, and other undesired local variables.
+        """
+        if key.startswith("_") or key_casefold in _EXCLUDE_KEYS:
+            return False
+        if "datafed" in key_casefold or "globus" in key_casefold:
+            return False
+        if isinstance(value, _EXCLUDE_TYPES):
+            return False
+        # functions and other callables are only kept if they are part of the model or the optimizer
+        return not callable(value) or key in model_names or key_casefold in _OPTIM_KEYS
+
+    def _list_metadata(self, key, value, model_parameters):
+        """
+        Adds a list to the metadata if it is not too long (arbitrarily chosen to be less than 1000 characters).
+        """
+        # ignore long lists
+        if _short_enough(value):
+            # extract the value for 1 item lists
+            if len(value) == 1:
+                model_parameters[key] = tensors_to_lists(value[0])
+            else:
+                # if the list has many (but not too many values) extract the whole list
+                model_parameters[key] = tensors_to_lists(value)
+        else:
+            warning_message = f'List in key "{key}" is too long to be extracted'
+            warnings.warn(warning_message)
+
+    def _array_metadata(self, key, value, model_parameters):
+        """
+        Adds a numpy array or torch tensor to the metadata as a list if it is small enough
+        (arbitrarily chosen to be smaller than the input data dimensions).
+        """
+        if self._input_numel is not None and self._smaller_than_input(value):
+            # put other lists into the Model Parameters dictionary
+            values = value.tolist()
+            model_parameters[key] = values if is_jsonable(values) else str(values)
+
+    def _smaller_than_input(self, value):
+        """
+        Checks whether a numpy array or torch tensor has fewer elements than the input data,
+        without converting it.
+
+        Args:
+            value (numpy.ndarray or torch.Tensor): The array to check.
+
+        Returns:
+            bool: True if the array has fewer elements than the input data.
+        """
+        numel = value.numel() if isinstance(value, torch.Tensor) else value.size
+        return numel < self._input_numel
+
+    def _string_metadata(self, key, value, model_parameters):
+        """
+        Adds paths and pytorch devices to the metadata as strings so they can be serialized into JSON.
+        """
+        model_parameters[key] = str(value)
+
+    def _dict_metadata(self, key, value, model_parameters):
+        """
+        Adds a non-empty dictionary to the metadata, as a string if it cannot be serialized into JSON.
+        """
+        if len(value) > 0 and "_" not in str(type(next(iter(value.values())))):
+            model_parameters[key] = value if is_jsonable(value) else str(value)
+
+    def _default_metadata(self, key, value, model_parameters):
+        """
+        Adds any other local variable to the metadata. Class instances are converted into
+        dictionaries of their attributes, everything else should be serializable (string, float, etc.).
+        """
+        # convert class instances into dictionaries of their attributes so they can be serialized into JSON
+        if hasattr(value, "__dict__"):
+            attributes = extract_instance_attributes(obj=value)
+            if attributes:
+                model_parameters[key] = attributes
+            return
+
+        # everything should be JSON serializable at this point, but try to convert to string and then skip if not
+        if is_jsonable(value):
+            model_parameters[key] = value
+            return
+
+        try:
+            model_parameters[key] = str(value)
+
+        except (TypeError, ValueError):
+            if self.logging:
+                self._log.exception(
+                    "Could not convert %s to JSON, skipping this variable. The value has type %s and value \n %r",
+                    key,
+                    type(value),
+                    value,
+                )
+
+    # handlers adding the local variables of each type to the metadata, see getMetadata.
+    # Read-only, as the handlers looked up for each type are cached
+    _METADATA_HANDLERS: ClassVar[types.MappingProxyType] = types.MappingProxyType(
+        {
+            list: _list_metadata,
+            np.ndarray: _array_metadata,
+            torch.Tensor: _array_metadata,
+            pathlib.PurePath: _string_metadata,
+            torch.device: _string_metadata,
+            dict: _dict_metadata,
+        }
+    )
+
+    @classmethod
+    @functools.cache
+    def _metadata_handler(cls, value_type):
+        """
+        Looks up the handler adding a local variable of the given type to the metadata.
+        The method resolution order is followed so that subclasses (e.g. torch.nn.Parameter)
+        use the handler of their base class. Only plain dictionaries use the dictionary
+        handler, dictionary subclasses (e.g. an OrderedDict state_dict) are class instances
+        and go to the default handler. The result is cached for each class and type, the
+        cache being safe to use from several threads.
+
+        Args:
+            value_type (type): The type of the local variable.
+
+        Returns:
+            function: The handler, called as handler(self, key, value, model_parameters).
+        """
+        return next(
+            (
+                cls._METADATA_HANDLERS[base]
+                for base in value_type.__mro__
+                if base in cls._METADATA_HANDLERS
+                and (base is not dict or value_type is dict)
+            ),
+            cls._default_metadata,
+        )
+
+    @staticmethod
+    def _block_signature(block):
+        """
+        Describes the state of a model architecture block that its serialization depends on: the identity
+        of its modules and parameters, and the public attributes of the modules (e.g. `training` or the
+        `p` of a dropout layer). Scalar attributes are compared by value, the others by identity.
+
+        Args:
+            block (nn.Module or object): The model architecture block.
+
+        Returns:
+            tuple: The signature of the block, equal for two calls if the serialization would be the same.
+        """
+        modules = block.modules() if isinstance(block, nn.Module) else (block,)
+        return tuple(
+            (
+                id(module),
+                tuple(id(p) for p in getattr(module, "_parameters", {}).values()),
+                tuple(
+                    (name, value if isinstance(value, _SCALAR_TYPES) else id(value))
+                    for name, value in vars(module).items()
+                    if not name.startswith("_")
+                ),
+            )
+            for module in modules
+        )
+
+    def _architecture_metadata(self, block):
+        """
+        Serializes a model architecture block with serialize_model and extract_instance_attributes.
+        The result is cached for each block until its modules, parameters or attributes change
+        (see `_block_signature`) or `reset` is called.
+
+        Args:
+            block (nn.Module): The model architecture block.
+
+        Returns:
+            dict: The serialized block. It is shared between checkpoints and must not be modified.
+        """
+        signature = self._block_signature(block)
+        entry = self._arch_cache.get(id(block))
+
+        # the cache keeps a reference to the block so its id cannot be reused
+        if entry is None or entry[0] is not block or entry[1] != signature:
+            serialized = serialize_model(block)
+            serialized.update(extract_instance_attributes(obj=block))
+            entry = (block, signature, serialized)
+            self._arch_cache[id(block)] = entry
+
+        return entry[2]
+
     def getModelArchitectureStateDict(self):
         """
         generates a dictionary where the key is the model architecture block
@@ -377,13 +830,69 @@ class TorchLogger:
             dict: A dictionary containing the model architecture state dictionaries
 
         """
-        model_architecture = {}
+        # the returned tensors belong to the caller and are never released to the pool
+        model_architecture, copied, _ = self._snapshot_state_dicts()
 
-        for block in self.model_dict.keys():
-            model_architecture[block] = self.model_dict[block].state_dict()
+        # wait once for all the non-blocking copies from the GPU
+        if copied is not None:
+            copied.synchronize()
 
         return model_architecture
 
+    def _snapshot_state_dicts(self, copy=False):
+        """
+        Starts copying the state dictionaries of the model architecture blocks to the CPU,
+        so that torch.save writes the tensor storages directly.
+
+        With CUDA, the tensors are copied into pinned memory on a side stream and this method
+        returns without waiting for the copies. The training stream waits for the copies on
+        the GPU before it can modify the parameters, so the host is never blocked.
+
+        The tensors are copied into memory taken from the pool; release them with
+        `_save_checkpoint` once the snapshot is no longer needed.
+
+        Args:
+            copy (bool, optional): If True, tensors already on the CPU are copied too, so the
+                snapshot does not change when training continues. Defaults to False.
+
+        Returns:
+            tuple: The dictionary of the state dictionaries (see getModelArchitectureStateDict), a
+                torch.cuda.Event to synchronize before reading it, or None if it can be read right away,
+                and the list of tensors taken from the pool.
+        """
+        acquired = []
+
+        def allocate(shape, dtype):
+            tensor = self._pool.acquire(shape, dtype)
+            acquired.append(tensor)
+            return tensor
+
+        if self._copy_stream is None:
+            model_architecture = {
+                block: state_dict_to_cpu(
+                    module.state_dict(), allocate=allocate if copy else None
+                )
+                for block, module in self.model_dict.items()
+            }
+            return model_architecture, None, acquired
+
+        training_stream = torch.cuda.current_stream()
+
+        # the copies must see the parameters written by the training stream
+        self._copy_stream.wait_stream(training_stream)
+        with torch.cuda.stream(self._copy_stream):
+            model_architecture = {
+                block: state_dict_to_cpu(module.state_dict(), allocate=allocate)
+                for block, module in self.model_dict.items()
+            }
+            copied = torch.cuda.Event()
+            copied.record(self._copy_stream)
+
+        # the parameters must not be modified before they are copied
+        training_stream.wait_event(copied)
+
+        return model_architecture, copied, acquired
+
     def getUserClock(self):
         """
         Gathers system information including CPU, memory, and GPU details.
@@ -424,23 +933,16 @@ class TorchLogger:
                     )
 
                 except Exception:
-                    # the notebook is not already in DataFed, so upload it
-                    # output to user
-                    old_checksum = ""
-
+                    # the notebook is not already in DataFed, so it is uploaded below
                     if self.logging:
-                        with open(self.log_file_path, "a") as f:
-                            timestamp = (
-                                datetime.now()
-                                .astimezone()
-                                .strftime("%Y-%m-%d %H:%M:%S")
-                            )
-                            f.write(
-                                f"\n {timestamp} - Uploading notebook {self.__file__} to DataFed..."
-                            )
+                        self._log.debug(
+                            "Notebook %s was not found on DataFed",
+                            self.__file__,
+                            exc_info=True,
+                        )
 
             # generate a checksum (and scipt path) for the notebook
-            self.notebook_metadata = getNotebookMetadata(self.__file__)
+            self.notebook_metadata = getNotebookMetadataCached(self.__file__)
             if self.notebook_metadata is None:
                 raise ValueError(f"Failed to get metadata for notebook {self.__file__}")
 
@@ -458,13 +960,7 @@ class TorchLogger:
             if new_checksum != old_checksum:
                 # do the uploading
                 if self.logging:
-                    with open(self.log_file_path, "a") as f:
-                        timestamp = (
-                            datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                        f.write(
-                            f"\n {timestamp} - Uploading notebook {self.__file__} to DataFed..."
-                        )
+                    self._log.info("Uploading notebook %s to DataFed...", self.__file__)
 
                 current_user, current_time = self.getUserClock()
 
@@ -474,7 +970,7 @@ class TorchLogger:
                 }
 
                 # store the dataset Datafed ID in self.dataset_id. Upload the dataset to DataFed if necessary
-                self.dataset_id = self.df_api.upload_dataset_to_DataFed()
+                self._get_dataset_id()
 
                 self.notebook_record_resp = self.df_api.data_record_create(
                     metadata=self.notebook_metadata,
@@ -482,8 +978,12 @@ class TorchLogger:
                     deps=self.df_api.addDerivedFrom(self.dataset_id),
                 )
 
-                self.df_api.upload_file(
-                    self.notebook_record_resp[0].data[0].id, self.__file__
+                # upload the notebook in the background; it is waited for before the first checkpoint upload
+                self._wait_notebook_upload()
+                self._notebook_upload = self._upload_pool.submit(
+                    self.df_api.upload_file,
+                    self.notebook_record_resp[0].data[0].id,
+                    self.__file__,
                 )
 
                 self.notebook_record_id = self.notebook_record_resp[0].data[0].id
@@ -504,6 +1004,9 @@ class TorchLogger:
         and optionally uploads it to DataFed along with the model's metadata.
         If you want to upload multiple files to the same DataFed data record you can zip them
         together and pass in the local path to the zip file as "local_file_path".
+        With consistency="wb" the checkpoint is saved locally as soon as the background
+        writer dequeues it, and uploaded to DataFed with the next batch; call `flush` to
+        wait for both.
 
         Args:
             record_file_name (str): The name of the file to save the model locally.
@@ -515,92 +1018,116 @@ class TorchLogger:
             **kwargs: Additional metadata or attributes to include in the record.
         """
 
+        # the checkpoint is written by the background writer if it is committed there
+        deferred = datafed and self.consistency == "wb"
+        pending_save = None
+
         # include the model architecture state dictionary and model hyperparameters in the checkpoint
         if (
             local_file_path is not None
             and not str(local_file_path).endswith(".zip")
             and not os.path.exists(str(local_file_path))
         ):
-            checkpoint = self.getModelArchitectureStateDict()
+            checkpoint, copied, acquired = self._snapshot_state_dicts(copy=deferred)
             checkpoint.update(model_hyperparameters or {})
 
-            # Save the model state dict locally
-            torch.save(checkpoint, local_file_path)
+            pending_save = (checkpoint, copied, acquired, local_file_path)
+            if not deferred:
+                # Save the model state dict locally
+                self._save_checkpoint(*pending_save)
+                pending_save = None
 
         if datafed:
-            # Safely retrieve values and replace with None if undefined or not present
-            notebook_record_id = (
-                self.notebook_record_id
-                if self.notebook_record_id and len(self.notebook_record_id) > 0
-                else None
+            # Generate the metadata now, while local_vars still describe this checkpoint
+            metadata = self.getMetadata(
+                local_vars=local_vars,
+                model_hyperparameters=model_hyperparameters,
+                **kwargs,
             )
 
-            # Saves the record id to the object
-            self.notebook_record_id = notebook_record_id
+            # Serialize the metadata once. This also snapshots the values that are still
+            # referenced by the training code, before a queued checkpoint is committed.
+            metadata = dumps(metadata)
 
-            current_checkpoint_id = (
-                self.current_checkpoint_id
-                if self.current_checkpoint_id is not None
-                else None
-            )
+            checkpoint_record = (str(record_file_name), metadata, str(local_file_path))
 
-            self.dataset_id = self.df_api.upload_dataset_to_DataFed()
-            # Create a list of IDs, excluding any that are None
-            if isinstance(self.dataset_id, str):
-                ids_to_add = [
-                    id
-                    for id in [
-                        notebook_record_id,
-                        current_checkpoint_id,
-                        self.dataset_id,
-                    ]
-                    if id is not None
-                ]
-            elif isinstance(self.dataset_id, list):
-                ids_to_add = [
-                    id
-                    for id in [notebook_record_id, current_checkpoint_id]
-                    if id is not None
-                ]
-                for id in self.dataset_id:
-                    if self.dataset_id is not None:
-                        ids_to_add.append(id)
-            else:  # self.dataset_id is None:
-                ids_to_add = [
-                    id
-                    for id in [notebook_record_id, current_checkpoint_id]
-                    if id is not None
-                ]
-
-            # Call the API method with the valid IDs (if any)
-            if ids_to_add:
-                deps = self.df_api.addDerivedFrom(ids_to_add)
+            if deferred:
+                # the background writer saves the checkpoint and commits it to DataFed
+                self._write_q.put((checkpoint_record, pending_save))
             else:
-                deps = None  # If no valid IDs are present, set deps to None
+                self._commit([checkpoint_record])
 
-            # if isinstance(deps, list):
-            #     deps = functools.reduce(operator.iconcat, deps, []) #[item for sublist in deps for item in sublist]
+    def _save_checkpoint(self, checkpoint, copied, acquired, local_file_path):
+        """
+        Saves a checkpoint locally once its tensors have been copied to the CPU,
+        then returns the memory holding the copies to the pool.
 
-            # Generate metadata and create a data record in DataFed
-            metadata = self.getMetadata(
-                local_vars=local_vars,
-                model_hyperparameters=model_hyperparameters,
-                **kwargs,
-            )
+        Args:
+            checkpoint (dict): The checkpoint to save.
+            copied (torch.cuda.Event or None): The event recorded after the copies of the tensors.
+            acquired (list): The tensors of the checkpoint taken from the pool.
+            local_file_path (str or Path.PosixPath): The local file path to save the checkpoint to.
+        """
+        if copied is not None:
+            copied.synchronize()
+
+        try:
+            torch.save(checkpoint, local_file_path, _use_new_zipfile_serialization=True)
+        finally:
+            for tensor in acquired:
+                self._pool.release(tensor)
 
-            dc_resp = self.df_api.data_record_create(
-                metadata,
-                record_title=str(record_file_name),
-                local_model_path=self.local_model_path,
-                # weights_file_path = weights_file_path,
-                # embedding_file_path = embedding_file_path,
-                # reconstruction_file_path = reconstruction_file_path,
-                deps=deps,
+    def _commit(self, checkpoint_records):
+        """
+        Creates the DataFed records of the checkpoints and uploads the saved files.
+        Each checkpoint is marked as derived from the checkpoint before it.
+
+        Args:
+            checkpoint_records (list): A list of (record title, JSON metadata, local file path) tuples,
+                in the order the checkpoints were saved.
+        """
+        self._get_dataset_id()
+
+        # Create a list of the IDs the first checkpoint derives from, excluding any that are None
+        ds = self.dataset_id if isinstance(self.dataset_id, list) else [self.dataset_id]
+        ids_to_add = [
+            i for i in (self.notebook_record_id, self.current_checkpoint_id, *ds) if i
+        ]
+        deps = self.df_api.addDerivedFrom(ids_to_add) if ids_to_add else None
+
+        # the checkpoints after the first derive from the checkpoint before them, not from current_checkpoint_id
+        chained_deps = self.df_api.addDerivedFrom(
+            [i for i in ids_to_add if i != self.current_checkpoint_id]
+        )
+
+        # create the DataFed records of the checkpoints in one batch
+        dc_resps = self.df_api.data_record_create_batch(
+            [
+                {
+                    "metadata": metadata,
+                    "record_title": record_title,
+                    "local_model_path": self.local_model_path,
+                    "deps": deps if i == 0 else chained_deps,
+                }
+                for i, (record_title, metadata, _) in enumerate(checkpoint_records)
+            ],
+            chain=True,
+        )
+
+        # Upload the saved models to DataFed in parallel
+        uploads = [
+            self._upload_pool.submit(
+                self.df_api.upload_file, dc_resp[0].data[0].id, local_file_path
             )
-            # Upload the saved model to DataFed
-            self.df_api.upload_file(dc_resp[0].data[0].id, str(local_file_path))
+            for dc_resp, (_, _, local_file_path) in zip(dc_resps, checkpoint_records)
+        ]
+
+        # only move the chain of checkpoints forward once every upload, including the notebook's, succeeded
+        self._wait_notebook_upload()
+        for upload in uploads:
+            upload.result()
 
-            self.current_checkpoint_id = dc_resp[0].data[0].id
+        self.current_checkpoint_id = dc_resps[-1][0].data[0].id
 
 
 class InferenceEvaluation:
@@ -621,15 +1148,61 @@ class InferenceEvaluation:
         self.df_api = df_api
         self.skip = skip
 
+        # paths of the files under root_directory by file name, built on the first lookup, see _find_file
+        self._fs_index = None
+
+        # digests of the metadata last sent to DataFed for each record, see _serialize_loop
+        self._last_hash = {}
+
+        # threads fetching the checkpoints and updating the metadata, kept between runs, see _executor
+        self._executors = {}
+
         self.model = self.build_model(**Kwargs)
 
         # Create a logger
         self.logger = logging.getLogger(__name__)
         logging.basicConfig(level=logging.WARNING)
 
+    def _executor(self, name, max_workers):
+        """
+        Gets the threads of the given role, created on the first run and kept afterwards, so that the
+        DataFed connection opened by each thread is reused by the next runs (see `DataFed._mapi`).
+        The threads are only replaced if a different number of them is requested.
+
+        Args:
+            name (str): The role of the threads, e.g. "fetch" or "update".
+            max_workers (int): The number of threads.
+
+        Returns:
+            ThreadPoolExecutor: The threads.
+        """
+        workers, executor = self._executors.get(name, (None, None))
+
+        if workers != max_workers:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+            # each thread opens its own DataFed connection when it starts
+            connect_thread = getattr(self.df_api, "connect_thread", None)
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers, initializer=connect_thread
+            )
+            self._executors[name] = (max_workers, executor)
+
+        return executor
+
+    def close(self):
+        """
+        Stops the threads kept between runs, once their pending work is done.
+        """
+        for _, executor in self._executors.values():
+            executor.shutdown(wait=True)
+
+        self._executors.clear()
+
     def file_not_found(self, filename, row):
         self.logger.warning(
-            "{filename} was not found from DataFed using record id {row.id}"
+            "%s was not found from DataFed using record id %s", filename, row.id
         )
 
         print(
@@ -640,22 +1213,83 @@ class InferenceEvaluation:
 
         if ds_rep[0].task[0].status == 3:
             # Download was successful
-            self.logger.info(f"{filename} was downloaded successfully")
+            self.logger.info("%s was downloaded successfully", filename)
 
             # finds the downloaded file recursively
-            file_path = find_files_recursive(self.root_directory, filename)
+            file_path = self._find_file(filename)
 
             return file_path
 
         else:
             # Download was not successful
-            self.logger.error(f"{filename} could not be downloaded")
+            self.logger.error("%s could not be downloaded", filename)
 
             # returns a None object
             return None
 
         return ds_rep
 
+    @staticmethod
+    def _build_file_index(root_directory):
+        """
+        Walks a directory once and indexes the files it contains by name. Like os.walk,
+        directories that cannot be read (including a missing root directory) are skipped.
+
+        Args:
+            root_directory (str): The directory to walk.
+
+        Returns:
+            collections.defaultdict: The absolute paths of the files for each file name.
+        """
+        index = collections.defaultdict(list)
+        if root_directory is None:
+            return index
+
+        directories = [root_directory]
+        while directories:
+            try:
+                entries = os.scandir(directories.pop())
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+
+                    if is_dir:
+                        directories.append(entry.path)
+                    else:
+                        index[entry.name].append(os.path.realpath(entry.path))
+
+        return index
+
+    def _find_file(self, filename):
+        """
+        Finds the files in root_directory matching a file name, using the file index when possible.
+
+        Args:
+            filename (str): The name of the file.
+
+        Returns:
+            list: The paths of the matching files, empty if none was found.
+        """
+        if self._fs_index is None:
+            self._fs_index = self._build_file_index(self.root_directory)
+
+        file_path = self._fs_index.get(filename)
+        if file_path:
+            return list(file_path)
+
+        # files added since the index was built and partial matches are searched for on disk
+        file_path = find_files_recursive(self.root_directory, filename)
+        if file_path:
+            self._fs_index[filename] = list(file_path)
+
+        return file_path
+
     def _getFileName(self, row):
         return self.df_api.getFileName(row.id)
 
@@ -667,27 +1301,56 @@ class InferenceEvaluation:
             return data
 
     def run_inference(self, row):
+        file_path = self._fetch(row)
+
+        if file_path is None:
+            return None
+
+        return self._evaluate_loaded(row, file_path)
+
+    def _fetch(self, row):
+        """
+        Finds the checkpoint file of a record, downloading it from DataFed if necessary.
+        Only does I/O, so it can run in a background thread.
+
+        Args:
+            row (pd.Series): A row from the dataframe containing the record id.
+
+        Returns:
+            list: The paths of the checkpoint files, or None if the file could not be downloaded.
+        """
         # retrive the filename from the API datarecords
         filename = self._getFileName(row)
 
         # checks if the file can be found in the root directory
-        file_path = find_files_recursive(self.root_directory, filename)
+        file_path = self._find_file(filename)
 
         if len(file_path) == 0:
             # if the file is not found, attempt to download it from DataFed
             file_path = self.file_not_found(filename, row)
 
-            file_path = self.get_first_entry_if_list(file_path)
-
-            if file_path is None:
+            if not file_path:
                 self.logger.info(
-                    f"{filename} could not be downloaded, skipping inference."
+                    "%s could not be downloaded, skipping inference.", filename
                 )
 
                 print(f"{filename} could not be downloaded, skipping inference.")
 
                 return None
 
+        return file_path
+
+    def _evaluate_loaded(self, row, file_path):
+        """
+        Loads the checkpoint into the model and evaluates it.
+
+        Args:
+            row (pd.Series): A row from the dataframe containing metadata and other information.
+            file_path (list): The paths of the checkpoint files, from `_fetch`.
+
+        Returns:
+            dict: The evaluation results as a dictionary.
+        """
         # load the model
         self.model.load(file_path[0])
 
@@ -723,30 +1386,364 @@ class InferenceEvaluation:
             "Child class must implement this method. This method should return evaluation results as a dictionary."
         )
 
-    def run(self):
-        for i, row in tqdm(self.df.iterrows(), total=self.df.shape[0]):
-            # set to restart and skip
-            if self.skip is not None and i <= self.skip:
-                continue
+    def _fast_precheck(self, row):
+        """
+        Checks, without any I/O, whether a record can be evaluated. Records failing the check are skipped before
+        anything is fetched for them. Can be overridden by the child class, e.g. to skip records from another
+        model; the parent class accepts every record.
 
-            # runs the inference
-            msg = self.run_inference(row)
+        Args:
+            row (pd.Series): A row from the dataframe containing metadata and other information.
 
-            # if file cannot be found, skip inference
-            if msg is None:
-                continue
+        Returns:
+            bool: True if the record should be evaluated.
+        """
+        return True
+
+    def _candidate_rows(self):
+        """
+        Selects the records to evaluate before the inference loop: the rows after `skip`, with a record id,
+        which pass `_fast_precheck`.
+
+        Returns:
+            list: The (row index, row) of the records to evaluate, in the order of the dataframe.
+        """
+        df = self.df
+
+        # set to restart and skip
+        if self.skip is not None:
+            df = df[df.index > self.skip]
+
+        # records without an id can be neither fetched nor updated
+        if "id" in df.columns:
+            df = df[df["id"].notna()]
+
+        return [(i, row) for i, row in df.iterrows() if self._fast_precheck(row)]
+
+    def shared_metadata(self):
+        """
+        Returns the metadata added to every evaluated record, e.g. the configuration of the evaluation.
+        It is serialized once per `run` instead of once per record. Can be overridden by the child class;
+        the parent class adds no shared metadata.
+
+        Returns:
+            dict or None: The metadata shared by every record. The results of `evaluate` take precedence
+                over it for the keys they both contain.
+        """
+        return
+
+    def run(self, prefetch_depth=4, max_workers=16, batch_size=64, max_inflight=32):
+        """
+        Runs the inference for every record of the dataframe and adds the results to the metadata of the records.
+        The checkpoint files of the next records are found or downloaded in background threads while the
+        current record is evaluated. The records are still evaluated in the order of the dataframe, and their
+        results are serialized into JSON on a separate thread and sent to DataFed in batches, in background threads.
+        The results returned by `evaluate` are serialized later, so they must not be modified afterwards.
+        The background threads are kept for the next runs until `close` is called.
+
+        Args:
+            prefetch_depth (int, optional): The number of records fetched ahead of the evaluation. Defaults to 4.
+            max_workers (int, optional): The number of metadata updates sent to DataFed at the same time. Defaults to 16.
+            batch_size (int, optional): The number of records updated by each request to DataFed. Defaults to 64.
+            max_inflight (int, optional): The number of batches submitted to DataFed but not yet sent, beyond which
+                the serialization, and in turn the evaluation, waits for the oldest one. Defaults to 32.
+
+        Raises:
+            Exception: The first error raised while updating the metadata of the records, once every update has finished.
+        """
+        # build the file index before it is used by several threads
+        if self._fs_index is None:
+            self._fs_index = self._build_file_index(self.root_directory)
+
+        updates = {}
+        serialize_errors = []
+
+        # serialize the metadata shared by every record once, as the members of a JSON object
+        shared = self.shared_metadata() or {}
+        shared_fragment = dumpb(shared)[1:-1] if shared else b""
+
+        # the results are serialized into JSON on their own thread, which submits the batches of updates
+        serialize_q = queue.Queue(maxsize=32)
+
+        update_pool = self._executor("update", max_workers)
+        fetch_pool = self._executor("fetch", max(prefetch_depth, 1))
+
+        serializer = threading.Thread(
+            target=self._serialize_loop,
+            args=(
+                serialize_q,
+                update_pool,
+                updates,
+                batch_size,
+                serialize_errors,
+                shared,
+                shared_fragment,
+                max_inflight,
+            ),
+            daemon=True,
+        )
+        serializer.start()
+
+        try:
+            rows = self._candidate_rows()
+
+            # bind the attributes used for every record to locals
+            run_fetched = self._run_fetched
+            put = serialize_q.put
+
+            for (i, row), file_path in tqdm(
+                prefetch(
+                    rows,
+                    lambda item: self._fetch(item[1]),
+                    depth=prefetch_depth,
+                    executor=fetch_pool,
+                ),
+                total=len(rows),
+            ):
+                if serialize_errors:
+                    break
+
+                msg = run_fetched(row, file_path)
+                if msg is not None:
+                    put((i, row.id, msg))
+
+        finally:
+            serialize_q.put(_STOP)
+            serializer.join()
+
+            # the update threads are kept after the run, so wait for the submitted updates
+            wait(updates)
+
+        errors = list(serialize_errors)
+        last_hash = self._last_hash
+        log_debug = self.logger.debug
+        log_info = self.logger.info
+        log_error = self.logger.error
+        updated = 0
+        for update in as_completed(updates):
+            try:
+                update.result()
+            except Exception as e:
+                for i, record_id, _ in updates[update]:
+                    log_error(
+                        "Updating the metadata of %s record %s failed: %s",
+                        i,
+                        record_id,
+                        e,
+                    )
+                errors.append(e)
+            else:
+                # logs the success of the inference, with a summary every 1000 records
+                for i, record_id, digest in updates[update]:
+                    last_hash[record_id] = digest
+                    log_debug("Inference for %s record %s was successful", i, record_id)
+
+                    updated += 1
+                    if updated % 1000 == 0:
+                        log_info("Updated the metadata of %d records", updated)
+
+        log_info("Updated the metadata of %d records in total", updated)
+
+        if errors:
+            raise errors[0]
+
+    def _run_fetched(self, row, file_path):
+        """
+        Evaluates a record once its checkpoint file is fetched.
+
+        Args:
+            row (pd.Series): A row from the dataframe containing metadata and other information.
+            file_path (list): The paths of the checkpoint files returned by `_fetch` for the row.
+
+        Returns:
+            dict: The evaluation results, or None if there is nothing to update.
+        """
+        # if file cannot be found, skip inference
+        if file_path is None:
+            return None
+
+        # runs the inference
+        return self._evaluate_loaded(row, file_path)
+
+    def _serialize_loop(
+        self,
+        serialize_q,
+        update_pool,
+        updates,
+        batch_size,
+        errors,
+        shared=None,
+        shared_fragment=b"",
+        max_inflight=32,
+    ):
+        """
+        Serializes the evaluation results put on a queue into JSON and submits them to DataFed in batches,
+        until `_STOP` is put on the queue. Runs on its own thread, see `run`.
+
+        Args:
+            serialize_q (queue.Queue): The (row index, record id, evaluation results) of the records to update.
+            update_pool (ThreadPoolExecutor): The threads updating the metadata on DataFed.
+            updates (dict): The submitted updates, mapped to the (row index, record id, metadata digest) of their records.
+            batch_size (int): The number of records updated by each request to DataFed.
+            errors (list): The errors raised while serializing the results are appended to it.
+            shared (dict, optional): The metadata shared by every record, see `shared_metadata`.
+            shared_fragment (bytes, optional): The members of `shared` serialized into JSON.
+            max_inflight (int, optional): The number of submitted batches not yet sent to DataFed, beyond which
+                the oldest one is waited for. Defaults to 32.
+        """
+        buffer = []
+        inflight = collections.deque()
+
+        def submit_updates():
+            # bound the serialized metadata waiting to be sent; errors are collected by run
+            while len(inflight) >= max_inflight:
+                wait([inflight.popleft()])
+
+            update = update_pool.submit(
+                self._batch_update, [(rid, md) for _, rid, md, _ in buffer]
+            )
+            updates[update] = [(i, rid, digest) for i, rid, _, digest in buffer]
+            inflight.append(update)
+            buffer.clear()
+
+        stopped = False
+        try:
+            # bind the attributes used for every record to locals
+            get = serialize_q.get
+            dumps_with_shared = self._dumps_with_shared
+            blake2b = hashlib.blake2b
+            last_hash = self._last_hash
+            log_debug = self.logger.debug
+
+            while True:
+                item = get()
+                if item is _STOP:
+                    stopped = True
+                    break
+
+                # keep draining the queue after an error so the evaluation does not block
+                if errors:
+                    continue
+
+                try:
+                    i, record_id, msg = item
+                    payload = dumps_with_shared(msg, shared, shared_fragment)
+
+                    # skip the records whose metadata was already sent
+                    digest = blake2b(payload, digest_size=16).digest()
+                    if last_hash.get(record_id) == digest:
+                        log_debug("Metadata of record %s is unchanged", record_id)
+                        continue
+
+                    buffer.append((i, record_id, payload, digest))
+                    if len(buffer) >= batch_size:
+                        submit_updates()
+                except Exception as e:
+                    errors.append(e)
+
+            if buffer and not errors:
+                submit_updates()
+
+        except Exception as e:
+            errors.append(e)
+
+        finally:
+            # the evaluation stops on the error, drain the queue until it does so it never blocks on a full queue
+            while not stopped:
+                stopped = serialize_q.get() is _STOP
+
+    @staticmethod
+    def _dumps_with_shared(msg, shared, shared_fragment):
+        """
+        Serializes the evaluation results of a record into JSON along with the shared metadata,
+        splicing in the already serialized shared metadata instead of serializing it again.
+
+        Args:
+            msg (dict): The evaluation results of the record.
+            shared (dict): The metadata shared by every record.
+            shared_fragment (bytes): The members of `shared` serialized into JSON, empty if there are none.
+
+        Returns:
+            bytes: The UTF-8 encoded JSON metadata of the record.
+        """
+        if not shared_fragment:
+            return dumpb(msg)
+
+        if not msg:
+            return b"{" + shared_fragment + b"}"
+
+        # the values of the record replace the shared ones, which cannot be done by splicing
+        if shared.keys() & msg.keys():
+            return dumpb({**shared, **msg})
+
+        return b"{" + shared_fragment + b"," + dumpb(msg)[1:]
+
+    def _batch_update(self, pairs):
+        """
+        Adds metadata to several DataFed records with as few dataBatchUpdate requests as possible.
+        The metadata is merged into the existing metadata of the records, like dataUpdate does.
+
+        Args:
+            pairs (list): A list of (record id, UTF-8 encoded JSON metadata) tuples.
+        """
+        # split the records so that each request stays under the DataFed payload limit
+        batches = [[]]
+        size = 2
+        for record_id, metadata in pairs:
+            record = b'{"id": ' + dumpb(record_id) + b', "md": ' + metadata + b"}"
+            if batches[-1] and size + len(record) + 1 > API._max_payload_size:
+                batches.append([])
+                size = 2
+            batches[-1].append(record)
+            size += len(record) + 1
+
+        # the JSON is written as bytes, without being decoded into a string
+        for batch in batches:
+            with tempfile.NamedTemporaryFile(
+                "wb", suffix=".json", delete=False
+            ) as batch_file:
+                batch_file.write(b"[" + b",".join(batch) + b"]")
+
+            try:
+                self.df_api.dataBatchUpdate([batch_file.name])
+            finally:
+                os.remove(batch_file.name)
+
+
+def _as_tuple(value):
+    """
+    Normalizes a str, list, or set argument into a tuple, which can be used as a cache key.
+    Sets are sorted so that the same keys always give the same tuple.
 
-            # updates the metadata of the record
-            self.df_api.dataUpdate(row.id, metadata=json.dumps(msg))
+    Args:
+        value (str, list, set, tuple, or None): The argument.
 
-            # logs the success of the inference
-            self.logger.info(f"Inference for {i} record {row.id} was successful")
+    Returns:
+        tuple or None: The argument as a tuple, or None if it is None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    return tuple(value)
 
 
-class TorchViewer(nn.Module):
+class TorchViewer:
     def __init__(self, DataFed_path, **kwargs):
         self.DataFed_path = DataFed_path
-        self.df_api = DataFed(self.DataFed_path, **kwargs)
+        self.df_api = get_client(self.DataFed_path, **kwargs)
+
+        # checkpoint metadata already retrieved for each set of arguments, see getModelCheckpoints
+        self._ckpt_cache = {}
+
+    def invalidate_checkpoints(self):
+        """
+        Forgets the checkpoint metadata retrieved so far, so the next call of `getModelCheckpoints`
+        retrieves it from DataFed again.
+        """
+        self._ckpt_cache.clear()
 
     def getModelCheckpoints(
         self,
@@ -754,24 +1751,101 @@ class TorchViewer(nn.Module):
         excluded_keys="script",
         non_unique=["id", "timestamp", "total_time"],
         format="pandas",
+        page_size=None,
+        page=None,
     ):
         """
         Retrieves the metadata record for a specified record ID.
+        The result is cached for each set of arguments until `invalidate_checkpoints` is called.
+
+        With `page_size`, the records of the collection are retrieved one page at a time so that only
+        one page is held in memory, and the pages are not cached. Records are only filtered and made
+        unique within each page. A page number can be stored and passed back as `page` to resume.
 
         Args:
             record_id (str): The ID of the record to retrieve.
             exclude_metadata (str, list, or None, optional): Metadata fields to exclude from the extraction record.
             excluded_keys (str, list, or None, optional): Keys if the metadata record contains to exclude.
             non_unique (str, list, or None, optional): Keys which are expected to be unique independent of record uniqueness - these are not considered when finding unique records.
-            format (str, optional): The format to return the metadata in. Defaults to "pandas".
+            format (str, optional): The format to return the metadata in, "pandas" or "arrow". Defaults to "pandas".
+            page_size (int, optional): The number of records in each page. Defaults to None, retrieving every record at once.
+            page (int, optional): The page to return, starting from 0. Defaults to None, returning a generator
+                of the pages from the first one.
 
         Returns:
             dict: The metadata record.
         """
+        # normalize the arguments once, "computing" is a keyword rather than a metadata field
+        if exclude_metadata != "computing":
+            exclude_metadata = _as_tuple(exclude_metadata)
+        excluded_keys = _as_tuple(excluded_keys)
+        non_unique = _as_tuple(non_unique)
+
+        if page_size is not None:
+            kwargs = {
+                "exclude_metadata": exclude_metadata,
+                "excluded_keys": excluded_keys,
+                "non_unique": non_unique,
+                "format": format,
+            }
+            if page is not None:
+                return self._checkpoint_page(page, page_size, **kwargs)[0]
+            return self._checkpoint_pages(page_size, **kwargs)
+
+        key = (exclude_metadata, excluded_keys, non_unique, format)
+
+        if key not in self._ckpt_cache:
+            checkpoints = self.df_api.get_metadata(
+                exclude_metadata=exclude_metadata,
+                excluded_keys=excluded_keys,
+                non_unique=non_unique,
+                format=format,
+            )
+
+            # errors are not cached
+            if isinstance(checkpoints, Exception):
+                return checkpoints
+
+            self._ckpt_cache[key] = checkpoints
+
+        checkpoints = self._ckpt_cache[key]
+
+        # return a copy so that callers modifying the dataframe do not change the cache, Arrow tables are immutable
+        return checkpoints.copy() if format == "pandas" else checkpoints
+
+    def _checkpoint_page(self, page, page_size, **kwargs):
+        """
+        Retrieves the metadata of one page of the records in the collection.
 
-        return self.df_api.get_metadata(
-            exclude_metadata=exclude_metadata,
-            excluded_keys=excluded_keys,
-            non_unique=non_unique,
-            format=format,
+        Args:
+            page (int): The page to retrieve, starting from 0.
+            page_size (int): The number of records in each page.
+            **kwargs: The arguments of `DataFed.get_metadata`.
+
+        Returns:
+            tuple: The metadata of the page and the number of records in the page before filtering.
+        """
+        record_ids = self.df_api.getIDsInCollection(
+            offset=page * page_size, count=page_size
+        )
+        return self.df_api.get_metadata(record_ids=record_ids, **kwargs), len(
+            record_ids
         )
+
+    def _checkpoint_pages(self, page_size, **kwargs):
+        """
+        Yields the metadata of the records in the collection one page at a time.
+        The next pages of the collection are listed while the current one is retrieved,
+        see `DataFed.iter_collection_pages`.
+
+        Args:
+            page_size (int): The number of records in each page.
+            **kwargs: The arguments of `DataFed.get_metadata`.
+
+        Yields:
+            The metadata of each page.
+        """
+        for items in self.df_api.iter_collection_pages(page_size=page_size):
+            yield self.df_api.get_metadata(
+                record_ids=[record.id for record in items], **kwargs
+            )
@@ -1,19 +1,52 @@
 import ast
+import collections
+import functools
 import inspect
-import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from m3util.notebooks.checksum import calculate_notebook_checksum
 
 
-def is_jsonable(x):
-    try:
-        json.dumps(x)
+def is_jsonable(x, _parents=None):
+    """
+    Checks whether an object can be serialized into JSON without a custom encoder.
+
+    The object is walked instead of being serialized with json.dumps, so checking a
+    large list or dictionary does not build its JSON string. Like json.dumps, containers
+    referencing themselves are not serializable.
+
+    Args:
+        x (any): The object to check.
+
+    Returns:
+        bool: True if the object only consists of strings, numbers, booleans, None,
+            lists, tuples and dictionaries with such keys, False otherwise.
+    """
+    if x is None or isinstance(x, (str, int, float)):
         return True
-    except:
+    elif not isinstance(x, (list, tuple, dict)):
+        return False
+
+    # ids of the containers enclosing x, a repeated id is a circular reference
+    _parents = set() if _parents is None else _parents
+    if id(x) in _parents:
         return False
 
+    _parents.add(id(x))
+    try:
+        if isinstance(x, dict):
+            return all(
+                (key is None or isinstance(key, (str, int, float)))
+                and is_jsonable(value, _parents)
+                for key, value in x.items()
+            )
+        return all(is_jsonable(value, _parents) for value in x)
+    finally:
+        _parents.discard(id(x))
+
 
 def extract_instance_attributes(obj=dict()):
     """
@@ -94,6 +127,34 @@ def getNotebookMetadata(file):
         return file_info
 
 
+@functools.lru_cache(maxsize=8)
+def _notebook_metadata_by_stat(file, mtime_ns, size):
+    """
+    Caches getNotebookMetadata for each version (modification time and size) of the file.
+    """
+    return getNotebookMetadata(file)
+
+
+def getNotebookMetadataCached(file):
+    """
+    Same as getNotebookMetadata, but the checksum is only recalculated when
+    the script or notebook file has been modified since it was last calculated.
+    A file is considered modified when its modification time or its size changed,
+    so rewrites within the timestamp resolution of the filesystem are still detected.
+
+    Returns:
+        dict: A dictionary containing the path and checksum of the script or notebook file.
+    """
+    if file is None:
+        return None
+
+    stat = os.stat(file)
+    file_info = _notebook_metadata_by_stat(file, stat.st_mtime_ns, stat.st_size)
+
+    # return a copy so callers cannot modify the cached metadata
+    return {"script": dict(file_info["script"])}
+
+
 def serialize_model(model_block):
     """
     Serializes the model architecture into a dictionary format with detailed layer information.
@@ -168,7 +229,7 @@ def serialize_model(model_block):
             for param, value in layer.__dict__.items():
                 # Filter out unnecessary attributes
                 if not param.startswith("_") and not callable(value):
-                    layer_descriptor["config"][param] = value
+                    layer_descriptor["config"][param] = tensors_to_lists(value)
 
             # Add the layer descriptor under the correct key
             current_level[layer_key] = layer_descriptor
@@ -195,4 +256,131 @@ def serialize_pytorch_optimizer(optimizer):
             ]
         else:
             state_dict_serializable[key] = value
-    return state_dict_serializable["param_groups"][0]
+    # hyperparameters such as the learning rate can be tensors
+    return tensors_to_lists(state_dict_serializable["param_groups"][0])
+
+
+def tensors_to_lists(obj):
+    """
+    Recursively converts the Torch tensors in nested dictionaries, lists and tuples to lists
+    so they can be serialized into JSON.
+
+    Args:
+        obj (any): The object to convert.
+
+    Returns:
+        any: The object with every tensor replaced by a list (or a Python number for 0-d tensors).
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.tolist()
+    elif isinstance(obj, dict):
+        return {key: tensors_to_lists(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [tensors_to_lists(value) for value in obj]
+    else:
+        return obj
+
+
+def contains_tensor(obj):
+    """
+    Checks whether nested dictionaries, lists and tuples contain a Torch tensor.
+
+    Args:
+        obj (any): The object to check.
+
+    Returns:
+        bool: True if a tensor was found, False otherwise.
+    """
+    if isinstance(obj, torch.Tensor):
+        return True
+    elif isinstance(obj, dict):
+        return any(contains_tensor(value) for value in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return any(contains_tensor(value) for value in obj)
+    else:
+        return False
+
+
+def state_dict_to_cpu(state, copy=False, allocate=None):
+    """
+    Detaches the tensors of a (nested) state dictionary and copies them to the CPU.
+    The copies are issued with non_blocking=True, so CUDA must be synchronized before they are read.
+
+    Args:
+        state (any): The state dictionary of a model or an optimizer, or a value within it.
+        copy (bool, optional): If True, tensors already on the CPU are copied too, so the result
+            does not change when the model is trained further. Defaults to False.
+        allocate (callable, optional): Called as allocate(shape, dtype) to get the CPU tensor
+            each tensor is copied into, for example pinned memory from a pool. Implies copy.
+            Defaults to None.
+
+    Returns:
+        any: The state dictionary with every tensor on the CPU.
+    """
+    if isinstance(state, torch.Tensor):
+        if allocate is not None:
+            return allocate(state.shape, state.dtype).copy_(
+                state.detach(), non_blocking=True
+            )
+        elif copy:
+            return state.detach().to("cpu", copy=True, non_blocking=True)
+        else:
+            return state.detach().to("cpu", non_blocking=True)
+    elif isinstance(state, dict):
+        state_cpu = type(state)(
+            (key, state_dict_to_cpu(value, copy, allocate))
+            for key, value in state.items()
+        )
+        # keep the version information used by load_state_dict
+        if hasattr(state, "_metadata"):
+            state_cpu._metadata = state._metadata
+        return state_cpu
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_dict_to_cpu(value, copy, allocate) for value in state)
+    else:
+        return state
+
+
+def prefetch(iterable, fetch, depth=8, max_workers=1, executor=None):
+    """
+    Calls `fetch` on the items of an iterable in background threads, up to `depth` items ahead of
+    the consumer, so that I/O bound fetching overlaps with the processing of the previous items.
+    The results are yielded in the order of the iterable.
+
+    Args:
+        iterable (iterable): The items to fetch.
+        fetch (callable): The function called on each item, e.g. a request to DataFed.
+        depth (int, optional): The number of items fetched ahead of the consumer. Defaults to 8.
+        max_workers (int, optional): The number of threads fetching the items. Defaults to 1.
+        executor (concurrent.futures.Executor, optional): The threads fetching the items, which are kept
+            running afterwards. Threads open their own DataFed connection, so a long-lived executor
+            reuses the connections across calls. Defaults to None, which uses `max_workers` new threads.
+
+    Yields:
+        tuple: Each item and the result of `fetch` on it.
+
+    Raises:
+        Exception: The error raised by `fetch`, when the result of the corresponding item is reached.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            yield from prefetch(iterable, fetch, depth=depth, executor=pool)
+        return
+
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append((item, executor.submit(fetch, item)))
+
+            if len(pending) > depth:
+                item, fetched = pending.popleft()
+                yield item, fetched.result()
+
+        while pending:
+            item, fetched = pending.popleft()
+            yield item, fetched.result()
+
+    finally:
+        # do not fetch the remaining items if the consumer stops early
+        for _, fetched in pending:
+            fetched.cancel()
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+datafed = pytest.importorskip("datafed_torchflow.datafed")
+
+
+class FakeMessageAPI:
+    """
+    Stands for the DataFed connection of a thread, authenticated with key files if `auth` is True.
+    """
+
+    auth = True
+
+    def __init__(self, **kwargs):
+        pass
+
+    def setNackExceptionEnabled(self, enabled):
+        pass
+
+    def getAuthStatus(self):
+        return self.auth, "u/user"
+
+
+@pytest.fixture
+def df_api(monkeypatch):
+    monkeypatch.setattr(datafed.MessageLib, "API", FakeMessageAPI)
+
+    # the connection opened by the DataFed API on the creating thread
+    df_api = datafed.DataFed.__new__(datafed.DataFed)
+    monkeypatch.setattr(df_api, "_setSaneDefaultOptions", dict, raising=False)
+    df_api._mapi = FakeMessageAPI()
+    df_api._prefetch_pool = None
+    df_api._prefetch_lock = threading.Lock()
+    yield df_api
+    df_api.close()
+
+
+def _connection_of_thread(df_api):
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(df_api._mapi))
+    thread.start()
+    thread.join()
+    return connections[0]
+
+
+def test_pool_threads_open_their_own_connection(df_api):
+    owner = df_api._mapi
+
+    with df_api.thread_pool(2) as pool:
+        connections = {pool.submit(lambda: df_api._mapi).result() for _ in range(8)}
+
+    assert owner not in connections
+    assert 1 <= len(connections) <= 2
+
+    # threads outside the pools share the connection of the creating thread
+    assert _connection_of_thread(df_api) is owner
+
+
+def test_prefetch_thread_keeps_its_connection(df_api):
+    first = df_api._prefetcher().submit(lambda: df_api._mapi).result()
+    second = df_api._prefetcher().submit(lambda: df_api._mapi).result()
+
+    assert first is second
+    assert first is not df_api._mapi
+
+
+def test_unauthenticated_pool_thread_raises(df_api, monkeypatch):
+    monkeypatch.setattr(FakeMessageAPI, "auth", False)
+
+    with pytest.raises(RuntimeError, match="could not be authenticated"):
+        df_api.connect_thread()
@@ -0,0 +1,55 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+datafed = pytest.importorskip("datafed_torchflow.datafed")
+
+
+def _metadata_record(epoch, record_id):
+    return {
+        "Model Parameters": {
+            "Model Hyperparameters": {"learning_rate": 0.001, "epoch": epoch},
+            "Model Architecture": {"layers": [16, 32]},
+        },
+        "System Information": {"cpu": {"count": 8}},
+        "id": record_id,
+    }
+
+
+def test_get_metadata_non_unique_nested_metadata(monkeypatch):
+    df_api = datafed.DataFed.__new__(datafed.DataFed)
+    df_api.collection_id = "c/123"
+
+    metadata = [
+        _metadata_record(1, "d/1"),
+        _metadata_record(1, "d/2"),
+        _metadata_record(2, "d/3"),
+    ]
+    monkeypatch.setattr(
+        df_api, "_get_metadata_list", lambda record_ids, exclude=None: metadata
+    )
+
+    df = df_api.get_metadata(record_ids=["d/1", "d/2", "d/3"], non_unique="id")
+
+    assert list(df["id"]) == ["d/1", "d/3"]
+
+
+def test_get_metadata_excluded_keys(monkeypatch):
+    df_api = datafed.DataFed.__new__(datafed.DataFed)
+    df_api.collection_id = "c/123"
+
+    metadata = [
+        _metadata_record(1, "d/1"),
+        {**_metadata_record(2, "d/2"), "script": None},
+        {**_metadata_record(3, "d/3"), "script": "notebook.ipynb"},
+        _metadata_record(4, "d/4"),
+    ]
+    monkeypatch.setattr(
+        df_api, "_get_metadata_list", lambda record_ids, exclude=None: metadata
+    )
+
+    df = df_api.get_metadata(
+        record_ids=["d/1", "d/2", "d/3", "d/4"], excluded_keys="script"
+    )
+
+    assert list(df["id"]) == ["d/1", "d/4"]
+    assert "script" not in df.columns
@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytorch = pytest.importorskip("datafed_torchflow.pytorch")
+
+
+class FakeDataFed:
+    """
+    Records the metadata updates sent by InferenceEvaluation instead of sending them to DataFed.
+    """
+
+    def __init__(self):
+        self.updates = {}
+        self.payload_sizes = []
+
+    def getFileName(self, record_id):
+        return f"{record_id.split('/')[-1]}.pkl"
+
+    def dataBatchUpdate(self, paths):
+        for path in paths:
+            self.payload_sizes.append(os.path.getsize(path))
+            with open(path) as f:
+                for record in json.load(f):
+                    self.updates[record["id"]] = record["md"]
+
+
+class FakeModel:
+    def __init__(self):
+        self.loaded = []
+
+    def load(self, path):
+        self.loaded.append(path)
+
+
+class Evaluation(pytorch.InferenceEvaluation):
+    def build_model(self):
+        return FakeModel()
+
+    def evaluate(self, row, file_path):
+        return {"loss": row.epoch / 10}
+
+
+@pytest.fixture
+def evaluation(tmp_path):
+    for name in ("1", "2", "3"):
+        (tmp_path / f"{name}.pkl").write_bytes(b"")
+
+    df = pd.DataFrame({"id": ["d/1", "d/2", "d/3"], "epoch": [1, 2, 3]})
+    evaluation = Evaluation(df, "d/dataset", FakeDataFed(), root_directory=tmp_path)
+    yield evaluation
+    evaluation.close()
+
+
+def test_run_updates_every_record(evaluation, tmp_path):
+    evaluation.run(prefetch_depth=2, max_workers=2, batch_size=2)
+
+    assert evaluation.df_api.updates == {
+        "d/1": {"loss": 0.1},
+        "d/2": {"loss": 0.2},
+        "d/3": {"loss": 0.3},
+    }
+    assert evaluation.model.loaded == [
+        str((tmp_path / f"{name}.pkl").resolve()) for name in ("1", "2", "3")
+    ]
+
+
+def test_run_reuses_threads_until_closed(evaluation):
+    evaluation.run(prefetch_depth=2, max_workers=2)
+    executors = dict(evaluation._executors)
+
+    # unchanged metadata is not sent again
+    evaluation.df_api.updates.clear()
+    evaluation.run(prefetch_depth=2, max_workers=2)
+
+    assert evaluation._executors == executors
+    assert evaluation.df_api.updates == {}
+
+    evaluation.close()
+    assert evaluation._executors == {}
+
+
+class BrokenSerializerEvaluation(Evaluation):
+    @property
+    def _dumps_with_shared(self):
+        raise RuntimeError("serializer setup failed")
+
+
+def test_run_raises_when_the_serializer_fails(tmp_path):
+    # more records than the serialization queue holds
+    ids = [f"d/{i}" for i in range(100)]
+    for record_id in ids:
+        (tmp_path / FakeDataFed().getFileName(record_id)).write_bytes(b"")
+
+    df = pd.DataFrame({"id": ids, "epoch": range(100)})
+    evaluation = BrokenSerializerEvaluation(
+        df, "d/dataset", FakeDataFed(), root_directory=tmp_path
+    )
+
+    errors = []
+
+    def run():
+        try:
+            evaluation.run()
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    evaluation.close()
+
+    assert not thread.is_alive()
+    assert str(errors[0]) == "serializer setup failed"
+    assert evaluation.df_api.updates == {}
+
+
+def test_batch_update_splits_the_payload(evaluation, monkeypatch):
+    monkeypatch.setattr(pytorch.API, "_max_payload_size", 300)
+    pairs = [
+        (f"d/{i}", pytorch.dumpb({"loss": i / 10, "notes": "x" * 40}))
+        for i in range(10)
+    ]
+
+    evaluation._batch_update(pairs)
+
+    df_api = evaluation.df_api
+    assert len(df_api.payload_sizes) > 1
+    assert max(df_api.payload_sizes) <= 300
+    assert list(df_api.updates) == [record_id for record_id, _ in pairs]
+    assert df_api.updates["d/3"] == {"loss": 0.3, "notes": "x" * 40}
+
+
+def test_build_file_index_skips_unreadable_directories(tmp_path, monkeypatch):
+    (tmp_path / "readable").mkdir()
+    (tmp_path / "readable" / "a.pkl").write_bytes(b"")
+    (tmp_path / "unreadable").mkdir()
+    (tmp_path / "unreadable" / "b.pkl").write_bytes(b"")
+    (tmp_path / "c.pkl").write_bytes(b"")
+
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.basename(path) == "unreadable":
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(pytorch.os, "scandir", failing_scandir)
+    index = pytorch.InferenceEvaluation._build_file_index(str(tmp_path))
+
+    assert sorted(index) == ["a.pkl", "c.pkl"]
+    assert index["a.pkl"] == [str((tmp_path / "readable" / "a.pkl").resolve())]
+
+
+def test_build_file_index_of_a_missing_directory(tmp_path):
+    assert (
+        pytorch.InferenceEvaluation._build_file_index(str(tmp_path / "missing")) == {}
+    )
@@ -0,0 +1,188 @@
+import os
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytorch = pytest.importorskip("datafed_torchflow.pytorch")
+
+
+class FakeDataFed:
+    """
+    Records the checkpoints committed by TorchLogger instead of sending them to DataFed.
+    """
+
+    def __init__(self, datafed_path, local_model_path, **kwargs):
+        self.dataset_id_or_path = None
+        self.batches = []
+        self.uploads = []
+        self.error = None
+
+    def endpointDefaultGet(self):
+        return "endpoint"
+
+    def thread_pool(self, max_workers):
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    def connect_thread(self):
+        pass
+
+    def close(self):
+        pass
+
+    def upload_dataset_to_DataFed(self):
+        return None
+
+    def addDerivedFrom(self, ids):
+        return list(ids)
+
+    def data_record_create_batch(self, records, chain=True):
+        if self.error is not None:
+            raise self.error
+
+        self.batches.append([record["record_title"] for record in records])
+        return [
+            [
+                types.SimpleNamespace(
+                    data=[types.SimpleNamespace(id=f"d/{record['record_title']}")]
+                )
+            ]
+            for record in records
+        ]
+
+    def upload_file(self, record_id, local_file_path):
+        # the checkpoint must be saved before it is uploaded
+        assert os.path.exists(local_file_path)
+        self.uploads.append(record_id)
+
+
+@pytest.fixture
+def logger():
+    # the DataFed connection opened by __init__ is not needed by these tests
+    logger = pytorch.TorchLogger.__new__(pytorch.TorchLogger)
+    logger._arch_cache = {}
+    return logger
+
+
+def test_architecture_metadata_is_cached(logger):
+    model = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.Dropout(0.1))
+
+    assert logger._architecture_metadata(model) is logger._architecture_metadata(model)
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda model: model.eval(),
+        lambda model: setattr(model[1], "p", 0.5),
+        lambda model: setattr(model[0], "weight", torch.nn.Parameter(torch.ones(2, 2))),
+    ],
+    ids=["eval", "dropout", "parameter"],
+)
+def test_architecture_metadata_follows_the_model(logger, change):
+    model = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.Dropout(0.1))
+    before = logger._architecture_metadata(model)
+
+    change(model)
+    after = logger._architecture_metadata(model)
+
+    assert after is not before
+    assert after == pytorch.serialize_model(
+        model
+    ) | pytorch.extract_instance_attributes(obj=model)
+
+
+@pytest.fixture
+def write_back_logger(tmp_path, monkeypatch):
+    monkeypatch.setattr(pytorch, "DataFed", FakeDataFed)
+    monkeypatch.setattr(pytorch, "check_globus_file_access", lambda *args: None)
+
+    # no notebook is given, so the checksum of the training script is not computed
+    monkeypatch.setattr(
+        pytorch,
+        "getNotebookMetadataCached",
+        lambda path: {"script": {"path": path, "checksum": None}},
+    )
+
+    logger = pytorch.TorchLogger(
+        {"model": torch.nn.Linear(2, 2)},
+        "datafed/path",
+        local_model_path=str(tmp_path),
+        log_file_path=str(tmp_path / "log.txt"),
+        consistency="wb",
+        batch_size=2,
+        flush_interval=1000,
+    )
+    yield logger
+    logger.close()
+
+
+def _save(logger, tmp_path, name):
+    logger.save(
+        name,
+        local_file_path=tmp_path / f"{name}.pt",
+        local_vars=[],
+        model_hyperparameters={"epoch": 1},
+    )
+
+
+def test_write_back_commits_in_batches(write_back_logger, tmp_path):
+    for name in ("ckpt-1", "ckpt-2", "ckpt-3"):
+        _save(write_back_logger, tmp_path, name)
+    write_back_logger.flush()
+
+    df_api = write_back_logger.df_api
+    assert df_api.batches == [["ckpt-1", "ckpt-2"], ["ckpt-3"]]
+    # the checkpoints of a batch are uploaded in parallel
+    assert sorted(df_api.uploads) == ["d/ckpt-1", "d/ckpt-2", "d/ckpt-3"]
+    assert write_back_logger.current_checkpoint_id == "d/ckpt-3"
+
+    # the snapshots were returned to the pool once saved
+    assert write_back_logger._pool._bytes > 0
+
+
+def test_close_commits_the_queued_checkpoints(write_back_logger, tmp_path):
+    _save(write_back_logger, tmp_path, "ckpt-1")
+    write_back_logger.close()
+
+    assert not write_back_logger._writer.is_alive()
+    assert write_back_logger.df_api.batches == [["ckpt-1"]]
+    assert (tmp_path / "ckpt-1.pt").exists()
+
+
+def test_flush_raises_the_writer_error_once(write_back_logger, tmp_path):
+    write_back_logger.df_api.error = RuntimeError("DataFed is down")
+    _save(write_back_logger, tmp_path, "ckpt-1")
+
+    with pytest.raises(RuntimeError, match="DataFed is down"):
+        write_back_logger.flush()
+    write_back_logger.flush()
+
+    # the checkpoint is saved even though it could not be committed
+    assert (tmp_path / "ckpt-1.pt").exists()
+    assert write_back_logger.current_checkpoint_id is None
+
+
+def test_pinned_pool_reuses_released_tensors():
+    pool = pytorch._PinnedPool()
+
+    tensor = pool.acquire((4,), torch.float32)
+    pool.release(tensor)
+
+    assert pool.acquire((4,), torch.float32) is tensor
+    assert pool.acquire((4,), torch.float32) is not tensor
+
+
+def test_pinned_pool_drops_tensors_beyond_its_cap():
+    # room for a single tensor of 4 float32
+    pool = pytorch._PinnedPool(max_bytes=16)
+
+    first = pool.acquire((4,), torch.float32)
+    second = pool.acquire((4,), torch.float32)
+    pool.release(first)
+    pool.release(second)
+
+    assert pool._bytes == 16
+    assert pool.acquire((4,), torch.float32) is first
+    assert pool.acquire((4,), torch.float32) is not second
@@ -0,0 +1,85 @@
+import types
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytorch = pytest.importorskip("datafed_torchflow.pytorch")
+
+
+class FakeDataFed:
+    """
+    A collection of checkpoint records, counting the metadata requests of TorchViewer.
+    """
+
+    def __init__(self, count):
+        self.record_ids = [f"d/{i}" for i in range(count)]
+        self.requests = []
+
+    def iter_collection_pages(self, page_size=500):
+        for offset in range(0, len(self.record_ids), page_size):
+            yield [
+                types.SimpleNamespace(id=record_id)
+                for record_id in self.record_ids[offset : offset + page_size]
+            ]
+
+    def getIDsInCollection(self, offset=0, count=None):
+        return self.record_ids[offset : offset + count]
+
+    def get_metadata(self, record_ids=None, **kwargs):
+        self.requests.append(kwargs)
+        if record_ids is None:
+            record_ids = self.record_ids
+        return pd.DataFrame({"id": record_ids})
+
+
+@pytest.fixture
+def viewer():
+    # the DataFed connection opened by __init__ is not needed by these tests
+    viewer = pytorch.TorchViewer.__new__(pytorch.TorchViewer)
+    viewer.df_api = FakeDataFed(5)
+    viewer._ckpt_cache = {}
+    return viewer
+
+
+def test_checkpoints_are_cached(viewer):
+    first = viewer.getModelCheckpoints(non_unique=["id", "timestamp"])
+    first.loc[0, "id"] = "modified"
+
+    # the same arguments as a tuple hit the cache, which the caller cannot modify
+    second = viewer.getModelCheckpoints(non_unique=("id", "timestamp"))
+
+    assert len(viewer.df_api.requests) == 1
+    assert viewer.df_api.requests[0]["non_unique"] == ("id", "timestamp")
+    assert second.loc[0, "id"] == "d/0"
+
+
+def test_checkpoints_cache_is_per_arguments_and_invalidated(viewer):
+    viewer.getModelCheckpoints()
+    viewer.getModelCheckpoints(excluded_keys=None)
+    assert len(viewer.df_api.requests) == 2
+
+    viewer.invalidate_checkpoints()
+    viewer.getModelCheckpoints()
+    assert len(viewer.df_api.requests) == 3
+
+
+def test_checkpoint_pages(viewer):
+    pages = viewer.getModelCheckpoints(page_size=2)
+
+    assert [list(page["id"]) for page in pages] == [
+        ["d/0", "d/1"],
+        ["d/2", "d/3"],
+        ["d/4"],
+    ]
+
+
+def test_checkpoint_page(viewer):
+    assert list(viewer.getModelCheckpoints(page_size=2, page=1)["id"]) == [
+        "d/2",
+        "d/3",
+    ]
+    assert viewer.getModelCheckpoints(page_size=2, page=3).empty
+
+    # pages are not cached
+    viewer.getModelCheckpoints(page_size=2, page=1)
+    assert len(viewer.df_api.requests) == 3
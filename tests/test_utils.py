@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+utils = pytest.importorskip("datafed_torchflow.utils")
+
+
+def test_is_jsonable_nested():
+    assert utils.is_jsonable({"a": [1, 2.5, None, {"b": "c"}], 1: (True, "d")})
+    assert not utils.is_jsonable({"a": [1, {2}]})
+    assert not utils.is_jsonable({(1, 2): "tuple keys"})
+
+
+def test_is_jsonable_circular():
+    items = [1]
+    items.append(items)
+    mapping = {}
+    mapping["self"] = {"parent": mapping}
+
+    assert not utils.is_jsonable(items)
+    assert not utils.is_jsonable(mapping)
+
+
+def test_is_jsonable_shared_references():
+    # the same container twice is not a circular reference
+    shared = [1, 2]
+    assert utils.is_jsonable({"a": shared, "b": [shared, shared]})
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_prefetch_keeps_the_order(max_workers):
+    def fetch(item):
+        # later items finish first
+        time.sleep((10 - item) / 1000)
+        return item * 2
+
+    fetched = list(utils.prefetch(range(10), fetch, depth=4, max_workers=max_workers))
+
+    assert fetched == [(item, item * 2) for item in range(10)]
+
+
+def test_prefetch_fetches_at_most_depth_items_ahead():
+    started = []
+    lock = threading.Lock()
+
+    def fetch(item):
+        with lock:
+            started.append(item)
+        return item
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for consumed, _ in enumerate(
+            utils.prefetch(range(20), fetch, depth=3, executor=executor)
+        ):
+            # the consumed item, and up to depth items after it
+            with lock:
+                assert len(started) <= consumed + 1 + 3
+            time.sleep(0.001)
+
+
+def test_prefetch_cancels_the_remaining_items():
+    started = []
+
+    def fetch(item):
+        started.append(item)
+        time.sleep(0.01)
+        return item
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fetched = utils.prefetch(range(100), fetch, depth=3, executor=executor)
+        assert next(fetched) == (0, 0)
+        fetched.close()
+
+        # the executor is left running for the next calls
+        assert executor.submit(lambda: "still running").result() == "still running"
+
+    # the first item, the items fetched ahead of it, and at most one more already running
+    assert len(started) <= 5
+
+
+def test_prefetch_raises_the_fetch_error():
+    def fetch(item):
+        if item == 2:
+            raise ValueError("item 2")
+        return item
+
+    fetched = utils.prefetch(range(5), fetch, depth=2)
+
+    assert next(fetched) == (0, 0)
+    assert next(fetched) == (1, 1)
+    with pytest.raises(ValueError, match="item 2"):
+        next(fetched)